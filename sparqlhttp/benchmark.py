@@ -0,0 +1,92 @@
+"""
+timings of the result serializers and parsers, for checking which
+one is faster on a given machine:
+
+    python -m sparqlhttp.benchmark            # 10k, 100k, 1M rows
+    python -m sparqlhttp.benchmark 5000 50000
+
+Any other arguments are json result files (as saved from a server)
+to time the json decoders on, along with the generated ones.
+"""
+from __future__ import division
+import sys, time, os
+from rdflib import URIRef, Literal, BNode
+from sparqlhttp.sparqlxml import (xmlResults, fastXmlResults,
+     parseSparqlResults, iterParseSparqlResults, countSparqlResults)
+from sparqlhttp import sparqljson
+
+EX = "http://example.org/"
+XS_INT = URIRef("http://www.w3.org/2001/XMLSchema#integer")
+
+def sampleRows(n):
+    """n result rows that look like a typical SELECT ?s ?p ?o dump:
+    repeating predicates, some typed or language literals, a few
+    bnodes"""
+    preds = [URIRef(EX + "p%d" % i) for i in range(20)]
+    rows = []
+    for i in range(n):
+        s = URIRef(EX + "thing/%d" % (i // 10))
+        kind = i % 4
+        if kind == 0:
+            o = URIRef(EX + "class/%d" % (i % 50))
+        elif kind == 1:
+            o = Literal("name & title %d" % i, lang="en")
+        elif kind == 2:
+            o = Literal(str(i), datatype=XS_INT)
+        else:
+            o = BNode("b%d" % i)
+        rows.append({'s' : s, 'p' : preds[i % len(preds)], 'o' : o})
+    return rows
+
+def timed(func, *args):
+    t1 = time.time()
+    ret = func(*args)
+    return time.time() - t1, ret
+
+def benchXml(sizes):
+    sample = sampleRows(100)
+    assert parseSparqlResults(fastXmlResults(sample)) == sample
+
+    for n in sizes:
+        rows = sampleRows(n)
+        fast, doc = timed(fastXmlResults, rows)
+        stan, _ = timed(xmlResults, rows)
+        print "xml %8d rows: stan %7.2fs  fast %7.2fs  (%.1fx, %.1f MB)" % (
+            n, stan, fast, stan / fast, len(doc) / 1e6)
+        tree, _ = timed(parseSparqlResults, doc)
+        itered, _ = timed(lambda d: list(iterParseSparqlResults(d)), doc)
+        counted, _ = timed(countSparqlResults, doc)
+        print "      parse: tree %7.2fs  iterparse %7.2fs  count only %7.2fs" % (
+            tree, itered, counted)
+
+def benchJson(sizes, files=()):
+    """time each installed json decoder on parseJsonResults"""
+    docs = [("%d rows" % n, sparqljson.jsonResults(sampleRows(n),
+                                                   ['s', 'p', 'o']))
+            for n in sizes]
+    docs.extend((os.path.basename(f), open(f).read()) for f in files)
+
+    original = sparqljson.jsonBackend()
+    try:
+        for label, doc in docs:
+            times = []
+            for name, loads, takesBytes in sparqljson.jsonBackends:
+                sparqljson.setJsonBackend(name)
+                elapsed, _ = timed(sparqljson.parseJsonResults, doc)
+                times.append("%s %7.2fs" % (name, elapsed))
+            print "json %-14s (%.1f MB): %s" % (label, len(doc) / 1e6,
+                                                 "  ".join(times))
+    finally:
+        sparqljson.setJsonBackend(original)
+    print "json backend in use: %s" % original
+
+def main(args):
+    sizes = [int(a) for a in args if a.isdigit()]
+    files = [a for a in args if not a.isdigit()]
+    if not sizes and not files:
+        sizes = [10000, 100000, 1000000]
+    benchXml(sizes)
+    benchJson(sizes, files)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,301 @@
+"""
+client-side caches of query results, for the cache= argument of
+SyncGraph and AsyncGraph (see graph2.py).
+
+A cache scheme is any object with these methods:
+
+    get(key)
+        return the cached result, or Miss
+    set(key, result, query=None, initBindings=None)
+        remember a result. query and initBindings are the
+        uninterpolated query and its bindings, for schemes that want
+        to index the entry by what the query is about
+    invalidate(triples=None, context=None)
+        called just before the graph object writes the given triples
+        to the given context. triples=None means 'anything may have
+        changed'
+
+The key is an opaque hashable value made by the graph from the
+interpolated query, the prologue and the GET params. Results are the
+parsed rows (or the bool of an ASK), and the graph copies them before
+handing them out, so a cache never needs to copy anything itself.
+
+TermInterner, at the bottom, is a different kind of cache: it's for
+the result parsers.
+"""
+import threading, time, re
+from collections import OrderedDict
+from rdflib import URIRef, BNode, Literal
+
+class _Miss(object):
+    def __repr__(self):
+        return 'Miss'
+    def __nonzero__(self):
+        return False
+Miss = _Miss()
+
+class LRUCache(object):
+    """keeps the most recently used maxSize results. Any write
+    through the graph clears the whole cache.
+
+    Safe to share between threads.
+    """
+    def __init__(self, maxSize=1000):
+        self.maxSize = maxSize
+        self._entries = OrderedDict() # key : result, oldest use first
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                result = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return Miss
+            if not self._stillValid(key, result):
+                self._forget(key)
+                self.misses += 1
+                return Miss
+            self._entries[key] = result
+            self.hits += 1
+            return result
+        finally:
+            self._lock.release()
+
+    def set(self, key, result, query=None, initBindings=None):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = result
+            self._indexEntry(key, result, query, initBindings or {})
+            while len(self._entries) > self.maxSize:
+                oldest = iter(self._entries).next()
+                self._remove(oldest)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, triples=None, context=None):
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in list(self._entries):
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """dict of the counters, for logging or a status page"""
+        return dict(size=len(self._entries), maxSize=self.maxSize,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+    # subclasses extend these to keep their own per-entry data
+
+    def _indexEntry(self, key, result, query, initBindings):
+        pass
+
+    def _stillValid(self, key, result):
+        return True
+
+    def _forget(self, key):
+        """the entry for key is already gone from _entries; drop any
+        other data about it"""
+        pass
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._forget(key)
+
+class PredicateCache(LRUCache):
+    """expires each entry according to the predicates its query
+    mentions. ttl is a dict of predicate URIRef : seconds, e.g.
+
+        PredicateCache(ttl={RDFS.label : 3600, EXP['status'] : 1})
+
+    A query that mentions several of those predicates lives as long
+    as the shortest of their ttls. A query that mentions none of them
+    gets defaultTtl (0 means don't cache it at all).
+
+    'Mentions' is judged from the <uri> terms in the query text and
+    the URIRef values in initBindings, which covers value() and
+    label(). Prefixed names in the query text are not recognized.
+    """
+    def __init__(self, ttl=None, defaultTtl=0, maxSize=1000):
+        LRUCache.__init__(self, maxSize)
+        self.ttl = dict(ttl or {})
+        self.defaultTtl = defaultTtl
+        self._predicateCounts = {} # predicate : [hits, misses]
+
+    _now = time.time
+
+    # entries are stored as (result, predicates, expireTime)
+
+    def get(self, key):
+        entry = LRUCache.get(self, key)
+        if entry is Miss:
+            return Miss
+        result, preds, expires = entry
+        for pred in preds:
+            self._count(pred, 0)
+        return result
+
+    def set(self, key, result, query=None, initBindings=None):
+        preds = self._mentionedPredicates(query or '', initBindings or {})
+        for pred in preds:
+            # every set follows a miss on this key
+            self._count(pred, 1)
+        ttl = min([self.ttl.get(p, self.defaultTtl) for p in preds])
+        if ttl <= 0:
+            return
+        LRUCache.set(self, key, (result, preds, self._now() + ttl))
+
+    def _mentionedPredicates(self, query, initBindings):
+        """tuple of the predicates from self.ttl that this query
+        mentions, or (None,) if it mentions none"""
+        terms = set(URIRef(u) for u in re.findall(r'<([^>]+)>', query))
+        terms.update(v for v in initBindings.values()
+                     if isinstance(v, URIRef))
+        preds = tuple(t for t in terms if t in self.ttl)
+        return preds or (None,)
+
+    def _count(self, pred, which):
+        self._predicateCounts.setdefault(pred, [0, 0])[which] += 1
+
+    def _stillValid(self, key, entry):
+        return self._now() < entry[2]
+
+    def predicateStats(self):
+        """dict of predicate : dict(ttl, hits, misses, hitRate). The
+        None predicate counts the queries that used defaultTtl"""
+        ret = {}
+        for pred, (hits, misses) in self._predicateCounts.items():
+            ret[pred] = dict(ttl=self.ttl.get(pred, self.defaultTtl),
+                             hits=hits, misses=misses,
+                             hitRate=hits / float(hits + misses))
+        return ret
+
+class SubjectCache(LRUCache):
+    """invalidates everything about a resource whenever you write to
+    it, instead of the whole cache.
+
+    Entries are indexed by the URIRef/BNode bound to their subject
+    variable, which is any of the initBindings named in subjectVars
+    (value() and label() call theirs 's'). A write of (s, p, o) drops
+    the entries whose subject is s, or o if o is a resource. Entries
+    with no bound subject could be about anything (even if they bind
+    a predicate or an object), so every write drops them, and so does
+    a write with an unbound subject (like subgraphClear).
+
+    This assumes a query is only about the resources it binds: a query
+    that follows links from ?s to other subjects won't see writes to
+    those other subjects until its entry is evicted.
+    """
+    def __init__(self, maxSize=1000, subjectVars=('s', 'subj')):
+        LRUCache.__init__(self, maxSize)
+        self.subjectVars = subjectVars
+        self._bySubject = {} # term : set of keys
+        self._unbound = set() # keys that bound no subject
+        self._subjects = {} # key : terms
+
+    def _indexEntry(self, key, result, query, initBindings):
+        terms = set(v for k, v in initBindings.items()
+                    if k.lstrip('?') in self.subjectVars and
+                    isinstance(v, (URIRef, BNode)))
+        self._subjects[key] = terms
+        if not terms:
+            self._unbound.add(key)
+        for t in terms:
+            self._bySubject.setdefault(t, set()).add(key)
+
+    def _forget(self, key):
+        self._unbound.discard(key)
+        for t in self._subjects.pop(key, ()):
+            keys = self._bySubject[t]
+            keys.discard(key)
+            if not keys:
+                del self._bySubject[t]
+
+    def invalidate(self, triples=None, context=None):
+        if triples is None or [1 for t in triples if t[0] is None]:
+            self.clear()
+            return
+        written = set()
+        for s, p, o in triples:
+            written.add(s)
+            if isinstance(o, (URIRef, BNode)):
+                written.add(o)
+        self._lock.acquire()
+        try:
+            drop = set(self._unbound)
+            for t in written:
+                drop.update(self._bySubject.get(t, ()))
+            for key in drop:
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+class TermInterner(object):
+    """hands out one shared URIRef or Literal for each distinct term,
+    so results that repeat a predicate, class or datatype thousands
+    of times hold one copy of it (and dict and set lookups on those
+    terms hit the identity check first).
+
+    The parsers take one of these as their terms= argument, and the
+    graph clients keep one for all their results. When it has
+    maxSize terms, it forgets them all and starts over, which is
+    cheaper than tracking use and fine for terms that keep repeating.
+    """
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self._terms = {} # ('u', text) or ('l', value, datatype, lang) : term
+        self.hits = self.misses = self.clears = 0
+
+    def __len__(self):
+        return len(self._terms)
+
+    def uri(self, text):
+        key = ('u', text)
+        try:
+            ret = self._terms[key]
+            self.hits += 1
+            return ret
+        except KeyError:
+            return self._add(key, URIRef(text))
+
+    def literal(self, value, datatype=None, lang=None):
+        """datatype is the text of its URI"""
+        key = ('l', value, datatype, lang)
+        try:
+            ret = self._terms[key]
+            self.hits += 1
+            return ret
+        except KeyError:
+            if datatype is not None:
+                datatype = self.uri(datatype)
+            return self._add(key, Literal(value, lang=lang,
+                                          datatype=datatype))
+
+    def _add(self, key, term):
+        self.misses += 1
+        if len(self._terms) >= self.maxSize:
+            self._terms.clear()
+            self.clears += 1
+        self._terms[key] = term
+        return term
+
+    def clear(self):
+        self._terms.clear()
+
+    def stats(self):
+        """dict of the counters, for logging or a status page"""
+        return dict(size=len(self._terms), maxSize=self.maxSize,
+                    hits=self.hits, misses=self.misses, clears=self.clears)
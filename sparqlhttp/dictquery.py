@@ -1,5 +1,5 @@
 from __future__ import division
-import os, re, logging, time
+import os, re, logging, time, hashlib
 import sys
 import xml.sax
 
@@ -32,6 +32,22 @@ try:
 except ImportError:
     pass # older rdflib, no rdflib.sparql.Algebra
 
+# parseQuery(text, initNs) makes a query object that graph.query
+# accepts in place of the text, so we can skip the parse next time
+try:
+    from rdflib.plugins.sparql import prepareQuery
+    def parseQuery(text, initNs):
+        return prepareQuery(text, initNs=initNs)
+except ImportError:
+    try:
+        from rdflib.sparql.bison import Parse
+        def parseQuery(text, initNs):
+            return Parse(text)
+    except ImportError:
+        parseQuery = None # graph.query gets the text every time
+
+from sparqlhttp.cache import LRUCache, Miss
+
 log = logging.getLogger("Graph2")
 
 # a better name for this might be SparqlMethodsGraph, since it uses
@@ -49,6 +65,7 @@ class Graph2(object):
      countQuery: like query but returns the row count
      queryd: like query but returns each row as a dict instead of tuple
      contains: same as __contains__ but renamed to make remoteContains easier
+     addBulk: add an iterable of triples to one context with one addN and commit
 
     Unstable methods:
      dumpAllStatements: print to console
@@ -65,19 +82,38 @@ class Graph2(object):
     simplified cases.
     """
     
-    def __init__(self, graph, initNs={}, savePrefix="http://", saveRootDir='.'):
+    def __init__(self, graph, initNs={}, savePrefix="http://", saveRootDir='.',
+                 parsedQueryCacheSize=500, verifyWrites=False):
         """initNs will be used on all queries
 
         savePrefix and saveRootDir configure where output files will
         be saved. See save() for details.
+
+        parsedQueryCacheSize is how many distinct queries to keep
+        parsed, so running one again skips the sparql parser. 0 turns
+        this off.
+
+        verifyWrites makes add() look up every statement afterwards
+        and fail if it's not in the graph. That's slow; it's for
+        debugging stores.
         """
         self.__dict__.update(vars())
+        self._prepared = PreparedQueries(parsedQueryCacheSize)
+        self._parsed = None
+        if parsedQueryCacheSize and parseQuery is not None:
+            # (fixed query, initNs) : rdflib's parsed query
+            self._parsed = LRUCache(parsedQueryCacheSize)
         setupGetContextMethod(graph)
 
+    # counts the calls to _graphModified, so anything that caches
+    # results can tell whether they might be out of date
+    generation = 0
+
     def _graphModified(self):
         """this is called just before the graph gets modified, so you
-        can clear your caches or whatever"""
-        pass
+        can clear your caches or whatever. If you override it, call
+        this one too."""
+        self.generation += 1
 
     # this is weird for queryd to take a format arg. maybe i should
     # bring back query(), or make more variants for the other formats
@@ -90,29 +126,63 @@ class Graph2(object):
         if initBindings is None:
             initBindings = {}
 
-        query, initBindings = fixDatatypedLiterals(query, initBindings)
-
-        self._logQuery(query, initBindings)
-        #query, initBindings = fixBNodes(query, initBindings)
-
-        rows = self.graph.query(query, initBindings=initBindings,
-                                initNs=self.initNs)
+        prepared, rows = self._rawQuery(query, initBindings)
         if format != 'python':
             # or, use my sparqlxml.xmlResults() serializer
             return rows.serialize(format=format)
-        rows = list(rows)
-        log.debug("got %s rows" % len(rows))
+        if _askQuery.match(prepared.query):
+            return askAnswer(rows)
         def returnIterator():
             # this implementation is dumb, but I didn't bother with a
             # better one because the real sparql query method already has
             # the right dict at some point. It just doesn't return the
             # dict.
-            selection = sparqlSelection(query)
+            #
+            # The dicts are made as the caller pulls them, so a caller
+            # that streams (like SPARQLResource) never holds them all.
+            names = prepared.variables
             for row in rows:
-                yield dict(zip([x[1:] for x in selection], row))
+                yield dict(zip(names, row))
         return returnIterator()
 
 
+    def prepare(self, query):
+        """PreparedQuery for this query text, which you can pass to
+        queryd or countQuery in place of the text"""
+        return self._prepared.prepare(query)
+
+    def _rawQuery(self, query, initBindings):
+        """(PreparedQuery, rdflib result) for this query"""
+        prepared = self.prepare(query)
+        bindings = dict(prepared.fixBindings)
+        bindings.update(initBindings)
+
+        self._logQuery(prepared.fixed, bindings)
+        #query, initBindings = fixBNodes(query, initBindings)
+
+        return prepared, self.graph.query(self._parsedQuery(prepared),
+                                          initBindings=bindings,
+                                          initNs=self.initNs)
+
+    def _parsedQuery(self, prepared):
+        """rdflib's parsed version of the fixed query, from the
+        cache if we can, or else just the text"""
+        if self._parsed is None:
+            return prepared.fixed
+        key = (prepared.fixed, tuple(sorted(self.initNs.items())))
+        parsed = self._parsed.get(key)
+        if parsed is Miss:
+            parsed = parseQuery(prepared.fixed, self.initNs)
+            self._parsed.set(key, parsed)
+        return parsed
+
+    def queryCacheStats(self):
+        """dict of the stats() of the caches of prepared queries
+        (selections and fixDatatypedLiterals) and parsed queries"""
+        return dict(prepared=self._prepared.stats(),
+                    parsed=(self._parsed.stats()
+                            if self._parsed is not None else None))
+
     def _logQuery(self, query, initBindings):
         if URIRef('http://projects.bigasterisk.com/2006/01/syncImport/lastImportTime') not in initBindings.values():
             log.debug("fixed to %r %r" % (query, initBindings))
@@ -120,29 +190,50 @@ class Graph2(object):
     
     def countQuery(self, query, initBindings={}):
         # currently missing support for context, like queryd has
+        # (counts rdflib's rows without making the dicts queryd would)
+        prepared, rows = self._rawQuery(query, initBindings)
         n = 0
-        for row in self.queryd(query, initBindings):
+        for row in rows:
             n = n + 1
         return n
 
     def add(self, *triples, **context):
         """takes multiple triples at once (to reduce RPC calls).
         context arg is required"""
-        self._graphModified() # why is this at the top, before the
-                              # modification, instead of after the
-                              # commit? need to check the usage
         if isinstance(triples[0], list):
             triples = triples[0] # my newer APIs take a list here
         try:
             context = context['context']
         except KeyError:
             raise TypeError("'context' named argument is required")
+        self.addBulk(triples, context)
+
+    def addBulk(self, triples, context):
+        """add all the triples (any iterable of them) to the context,
+        handing them to the store in one addN and one commit"""
+        self._graphModified() # why is this at the top, before the
+                              # modification, instead of after the
+                              # commit? need to check the usage
+        if self.verifyWrites:
+            triples = list(triples)
+        counted = [0]
+        def quads():
+            for s, p, o in triples:
+                counted[0] += 1
+                yield s, p, o, subgraph
         subgraph = self.graph.get_context(context)
-        for stmt in triples:
-            subgraph.add(stmt)
-            assert stmt in subgraph
-            assert stmt in self.graph
+        t1 = time.time()
+        self.graph.addN(quads())
         self.graph.commit()
+        now = time.time()
+        n = counted[0]
+        if n > 1000:
+            log.info("added %s stmt to %s in %.1f sec (%.1f sps)" % (
+                n, context, now - t1, n / max(now - t1, .001)))
+        if self.verifyWrites:
+            for stmt in triples:
+                assert stmt in subgraph, stmt
+                assert stmt in self.graph, stmt
 
     def save(self, context):
         """serialize the context to an already-determined filename.
@@ -185,6 +276,14 @@ class Graph2(object):
         except StopIteration:
             return default
 
+    def labels(self, subjects, default=''):
+        """same as the graph2.py batch API; locally there's no round
+        trip to save"""
+        return [self.label(subj, default) for subj in subjects]
+
+    def values(self, subjects, pred, default=None):
+        return [self.value(subj, pred, default) for subj in subjects]
+
     def dumpAllStatements(self):
         print "Graph dump of %r:" % self
         print "ctx (subj, pred, obj)"
@@ -203,21 +302,51 @@ class Graph2(object):
         self._graphModified()
         self.graph.get_context(ctx).remove((None, None, None))
 
-    def safeParse(self, source, publicID=None, format="xml"):
+    def safeParse(self, source, publicID=None, format="xml", staged=True):
+        """graph.parse(source, publicID=ctx, format=fmt), replacing what
+        was in that context, but with no change to the graph if there's
+        a parse error.
+
+        The source is parsed once, into a separate in-memory graph,
+        and then the context is emptied and refilled from that with
+        one addN and one commit, so nothing can see the context half
+        empty. staged=False is the older way: parse the source twice,
+        once to check it and once straight into the cleared context.
+        """
+        if not staged:
+            return self._safeParseTwice(source, publicID, format)
+
+        log.info("parse %s for %s", source, publicID)
+        t1 = time.time()
+        staging = Graph()
+        try:
+            staging.parse(source, publicID=publicID, format=format)
+        except (xml.sax._exceptions.SAXParseException,
+                ParseError):
+            log.warn("parse error reading file. %s is unchanged", publicID)
+            raise
+        t2 = time.time()
+
+        self._graphModified()
+        subgraph = self.graph.get_context(publicID)
+        log.debug("replace %s", publicID)
+        subgraph.remove((None, None, None))
+        self.graph.addN((s, p, o, subgraph) for s, p, o in staging)
+        self.graph.commit()
+        now = time.time()
+        n = len(staging)
+        log.info("parsed %s stmt in %.1f sec, stored in %.1f sec (%.1f sps)" % (
+            n, t2 - t1, now - t2, n / max(now - t1, .001)))
+
+    def _safeParseTwice(self, source, publicID, format):
         if isinstance(source, StringInputSource):
-            # StringIO won't parse twice, which is the approach used
-            # below. Once that's fixed to parse only once, this block
-            # is not needed. See the other block below too
+            # StringIO won't parse twice, so keep the text for the
+            # second parse. See the other block below too
             saveTxt = source.getByteStream().read()
             source = StringInputSource(saveTxt)
         
         # the goal is to avoid clearing the ctx unless we know
-        # the new file parses ok. For now I do the parse
-        # twice, but if that slowdown is annoying (or if it's
-        # a problem that the file could change between
-        # parses), this can be rewritten to parse into a new
-        # graph and then copy to the main graph. Or parse into
-        # a new context and then rename the ctxs.
+        # the new file parses ok, so the first parse only checks it
         try:
             Graph().parse(source, publicID=URIRef('http://example.org/'), format=format)
         except (xml.sax._exceptions.SAXParseException,
@@ -312,6 +441,109 @@ def fixDatatypedLiterals(query, initBindings):
     
 ##     return query, initBindings
 
+class PreparedQuery(object):
+    """a query template that's been picked apart once, so it can be
+    run many times with different initBindings without going over
+    the text again. Get these from prepare() on a graph, then pass
+    them anywhere you'd pass the query string.
+
+    query is the original text, selection is sparqlSelection(query),
+    variables is the selection without the '?'s, checksum is the md5
+    hex of query (as utf-8), and fixed and fixBindings are what
+    fixDatatypedLiterals makes of it.
+
+    >>> q = PreparedQuery('SELECT ?x WHERE { ?x ?y ?z }')
+    >>> q.interpolate({'z' : Literal('hi'), 'x' : Literal('selected')})
+    u'SELECT ?x WHERE { ?x ?y "hi" }'
+    """
+    def __init__(self, query):
+        self.query = query
+        self.selection = sparqlSelection(query)
+        self.variables = [v[1:] for v in self.selection]
+        text = query
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+        self.checksum = hashlib.md5(text).hexdigest()
+        self.fixed, self.fixBindings = fixDatatypedLiterals(query, {})
+
+        brace = query.find('{')
+        self._prolog = query[:brace]
+        # [text, var, text, var, ..., text] for every ' ?var ' after
+        # the '{', the same ones interpolateSparql would replace
+        self._segments = re.split(r'(?<= )\?(\w+)(?= )', query[brace:])
+        self._selected = set(v[1:] for v in self.selection)
+
+    def __repr__(self):
+        return 'PreparedQuery(%r)' % self.query
+
+    def interpolate(self, initBindings):
+        """same as interpolateSparql(self.query, initBindings)"""
+        values = {}
+        for var, value in initBindings.items():
+            var = var.lstrip('?')
+            if var not in self._selected:
+                values[var] = value.n3()
+        segs = self._segments
+        out = [self._prolog]
+        for i in range(1, len(segs), 2):
+            out.append(segs[i - 1])
+            try:
+                out.append(values[segs[i]])
+            except KeyError:
+                out.append('?' + segs[i])
+        out.append(segs[-1])
+        return u''.join(out)
+
+class PreparedQueries(LRUCache):
+    """the PreparedQuery for each query text a graph has seen, so a
+    graph's prepare() is cheap to call again (and any query text you
+    pass to a graph is prepared this way anyhow). The fixDatatypedLiterals
+    and selection work is done once per text instead of on every call.
+
+    check(query), if given, runs on each new text before it's
+    prepared, e.g. to raise on bad syntax.
+    """
+    def __init__(self, maxSize=500, check=None):
+        LRUCache.__init__(self, maxSize)
+        self.check = check
+
+    def prepare(self, query):
+        """PreparedQuery for this query text (or query itself, if it's
+        already a PreparedQuery)"""
+        if isinstance(query, PreparedQuery):
+            return query
+        prepared = self.get(query)
+        if prepared is Miss:
+            if self.check is not None:
+                self.check(query)
+            prepared = PreparedQuery(query)
+            self.set(query, prepared)
+        return prepared
+
+# the PREFIX and BASE lines at the start of a query
+_prologue = re.compile(r'\s*((PREFIX\s+[^:\s]*:|BASE)\s*<[^>]*>\s*)*', re.I)
+
+# ASK after any PREFIX and BASE lines
+_askQuery = re.compile(_prologue.pattern + r'ASK\b', re.I)
+
+def splitPrologue(query):
+    """(the PREFIX and BASE lines, the rest of the query)
+
+    >>> splitPrologue('PREFIX ex: <http://ex/>\\nSELECT ?x WHERE { ?x ?y ?z }')
+    ('PREFIX ex: <http://ex/>\\n', 'SELECT ?x WHERE { ?x ?y ?z }')
+    """
+    end = _prologue.match(query).end()
+    return query[:end], query[end:]
+
+def askAnswer(result):
+    """True/False from rdflib's result for an ASK query"""
+    answer = getattr(result, 'askAnswer', None)
+    if isinstance(answer, list): # rdflib 2.4 keeps it in a list
+        answer = answer and answer[0]
+    if answer is None:
+        answer = bool(result)
+    return bool(answer)
+
 def sparqlSelection(query):
     if query.lstrip().startswith("ASK"):
         return []
@@ -1,16 +1,22 @@
-import urllib, hashlib, logging, restkit
+import urllib, logging, restkit
 from rdflib import RDFS
 from rdflib.exceptions import UniquenessError
 from twisted.internet import defer
-from twisted.web.client import getPage
-from sparqlhttp.sparqljson import parseJsonResults
-from sparqlhttp.remotegraph import interpolateSparql, _checkQuerySyntax, _addOptionalVars, makeDeferredFunc, graphFromTriples
+from twisted.web import error
+from sparqlhttp.sparqljson import parseJsonResults, JsonResultsParser
+from sparqlhttp.remotegraph import _checkQuerySyntax, _addOptionalVars, makeDeferredFunc, _copyRows, sparqlCountQuery, isAsk, SingleFlight
 from sparqlhttp.sesametxn import transactionDoc
+from sparqlhttp.dictquery import PreparedQuery, PreparedQueries
+from sparqlhttp.cache import LRUCache, Miss, TermInterner
+from sparqlhttp.httpclient import defaultClient
+from sparqlhttp.ntriples import encodeNTriples
 log = logging.getLogger("graph2")
 
 class _Graph2(object):
     def __init__(self, protocol, target, cache=None, initNs=None,
-                 getParams=None):
+                 getParams=None, etagCacheSize=200, countAggregate=None,
+                 httpClient=None, batchLookups=False, compactRows=False,
+                 termCacheSize=10000):
         """
         :Parameters:
             protocol
@@ -26,7 +32,10 @@ class _Graph2(object):
                 
             cache
                 Optional cache scheme object instance that can handle
-                get/set calls.
+                get/set/invalidate calls, such as
+                sparqlhttp.cache.LRUCache(). Writes made through this
+                graph object invalidate it; writes made by anyone
+                else don't.
 
             initNs
                 Dict of namespace prefix to URIRefs that will be used
@@ -36,6 +45,39 @@ class _Graph2(object):
             getParams
                 Dict of extra params to pass on GET requests (e.g. infer=false)
 
+            etagCacheSize
+                How many query results to remember along with their
+                ETags. Asking one of those queries again sends
+                If-None-Match, and if the server says 304 Not Modified
+                we use the remembered rows. 0 turns this off.
+
+            countAggregate
+                Whether the server can do SPARQL 1.1 COUNT(*), so
+                countQuery can get just the count instead of all the
+                rows. None means try it once and remember whether it
+                worked.
+
+            httpClient
+                AsyncGraph only: the sparqlhttp.httpclient.PooledHttpClient
+                that keeps connections to the server open between
+                requests. The default is one shared by all graphs.
+
+            batchLookups
+                AsyncGraph only: gather the value() and label() calls
+                made in the same reactor turn and send them as one
+                query per predicate (see values()).
+
+            compactRows
+                Return query rows as sparqlhttp.rows.Row objects
+                instead of dicts. They take much less memory, but they
+                can't be changed.
+
+            termCacheSize
+                How many distinct URIs and literals to share between
+                all the results we parse (see
+                sparqlhttp.cache.TermInterner). 0 means only share
+                them within each result.
+
         You may even ask for an Async version of an rdflib-berkeleydb
         graph, which simply wraps all the results in deferreds. This
         may be useful for testing.
@@ -49,23 +91,121 @@ class _Graph2(object):
         self._setRoot(target)
         self.target = target
         self.getParams = getParams or {}
+        self.cache = cache
+        self._generation = 0 # bumped on every write we make
+        self._etags = None
+        if etagCacheSize:
+            self._etags = LRUCache(etagCacheSize) # request : (etag, rows)
+        self.countAggregate = countAggregate
+        self._prepared = PreparedQueries(check=_checkQuerySyntax)
+        self.httpClient = httpClient
+        self.batchLookups = batchLookups
+        self.compactRows = compactRows
+        self.terms = None
+        if termCacheSize:
+            self.terms = TermInterner(termCacheSize)
+        self._pendingLookups = {} # pred : [(subj, default, any, deferred)]
 
     def _checkVersions(self):
         # override this with anything you need to check at startup
         pass
 
-    def _getQuery(self, query, initBindings, headers=None, _postProcess=None):
+    def _getQuery(self, query, initBindings, headers=None, _postProcess=None,
+                  _wrap=None):
         """send this query to the server, return deferred to the raw
-        server result. This is where the prologue (@PREFIX lines) is added."""
-        _checkQuerySyntax(query)
+        server result. This is where the prologue (@PREFIX lines) is added.
+
+        Results may come from self.cache instead of the server.
+
+        _wrap is an optional function to apply to the interpolated
+        query, like sparqlCountQuery."""
+        query = self.prepare(query)
+        params, sendHeaders = self._queryRequest(query, initBindings,
+                                                 headers, _wrap)
+
+        def finish(rows, copy):
+            if copy:
+                # the cache holds on to this result, so the caller
+                # (and _postProcess) must get their own rows
+                rows = _copyRows(rows)
+            if _postProcess is not None:
+                rows = _postProcess(rows)
+            return rows
+
+        requestKey = (self.resultFormat, tuple(sorted(params.items())))
+        cacheKey = None
+        if self.cache is not None and not headers:
+            cacheKey = requestKey
+            rows = self.cache.get(cacheKey)
+            if rows is not Miss:
+                # (finish may raise, which AsyncGraph must turn into
+                # a failed deferred, the same as for a miss)
+                return self._then(self._succeed(rows),
+                                  lambda rows: finish(rows, copy=True))
+
+        generation = self._generation
+        def fetch():
+            held = Miss
+            if self._etags is not None and not headers:
+                held = self._etags.get(requestKey)
+                if held is not Miss:
+                    sendHeaders['If-None-Match'] = held[0]
+
+            def post(response):
+                status, responseHeaders, body = response
+                if status == 304 and held is not Miss:
+                    ret = held[1]
+                else:
+                    ret = parseJsonResults(body, self.compactRows,
+                                           query.variables or None,
+                                           self.terms)
+                    if not (self.compactRows or
+                            isinstance(ret, bool)): # ASK result
+                        ret = _addOptionalVars(ret, query)
+                keep = held is not Miss
+                if self._etags is not None and not headers:
+                    etag = responseHeaders.get('etag')
+                    if etag:
+                        self._etags.set(requestKey, (etag, ret))
+                        keep = True
+                if cacheKey is not None and generation == self._generation:
+                    # (if we wrote while this was in flight, the result
+                    # might be older than the write)
+                    self.cache.set(cacheKey, ret, query.query, initBindings)
+                    keep = True
+                return ret, keep
+            return self._request(
+                "GET", path='',
+                queryParams=params,
+                headers=sendHeaders,
+                postProcess=post,
+                withResponse=True,
+                )
+
+        # (a query sent before one of our writes doesn't answer
+        # for after it)
+        flightKey = (generation, requestKey,
+                     tuple(sorted((headers or {}).items())))
+        return self._then(self._coalesce(flightKey, fetch),
+                          lambda (rows, keep): finish(rows, copy=keep))
+
+    def _queryRequest(self, query, initBindings, headers=None, wrap=None):
+        """(params, headers) for a GET of this PreparedQuery. wrap is an
+        optional function to apply to the interpolated query, like
+        sparqlCountQuery"""
         try:
-            interpolated = interpolateSparql(query, initBindings)
+            interpolated = query.interpolate(initBindings)
+            if wrap is not None:
+                interpolated = wrap(interpolated)
             log.debug("sparql request: %s", interpolated)
         except Exception:
             log.error("original query=%r, initBindings=%r" %
                       (query, initBindings))
             raise
 
+        params = {'query' : self.prologue + interpolated}
+        params.update(self.getParams)
+
         # for the stats system to group together all the queries that
         # vary only in their initBindings, I send a (reasonably)
         # unique value for the uninterpolated query too. If I could
@@ -74,7 +214,7 @@ class _Graph2(object):
         xBindings = (" ".join(initBindings.keys())).encode('utf8')
 
         sendHeaders = {'x-uninterpolated-query-checksum' :
-                       hashlib.md5(query).hexdigest(),
+                       query.checksum,
                        'x-bindings' : xBindings,
                        }
         if self.resultFormat == 'json':
@@ -84,43 +224,112 @@ class _Graph2(object):
             
         if headers:
             sendHeaders.update(headers)
+        return params, sendHeaders
 
-        def post(ret):
-            ret = parseJsonResults(ret)
-            if not isinstance(ret, bool): # ASK result
-                ret = _addOptionalVars(ret, query)
-            if _postProcess is not None:
-                ret = _postProcess(ret)
+    def queryStream(self, query, initBindings={}, onRows=None):
+        """like queryd, but the rows go to onRows(rows) a batch at a
+        time as they arrive from the server, so a huge result never
+        has to be in memory all at once. The result is the number of
+        rows. These don't use the cache, and ASK queries aren't
+        supported.
+
+        SyncGraph calls onRows before this returns; in AsyncGraph, the
+        deferred fires after the last onRows call."""
+        query = self.prepare(query)
+        params, sendHeaders = self._queryRequest(query, initBindings)
+        sendHeaders['Accept'] = 'application/sparql-results+json'
+        parser = JsonResultsParser(self.compactRows, query.variables or None,
+                                   self.terms)
+        count = [0]
+        def onChunk(data):
+            rows = parser.feed(data)
+            if rows:
+                count[0] += len(rows)
+                if not self.compactRows:
+                    rows = _addOptionalVars(rows, query)
+                onRows(rows)
+        def done(_):
+            parser.close()
+            return count[0]
+        return self._then(self._streamRequest(params, sendHeaders, onChunk),
+                          done)
+
+    def prepare(self, query):
+        """PreparedQuery for this query text, which you can pass to
+        queryd or countQuery in place of the text"""
+        return self._prepared.prepare(query)
+
+    def _graphModified(self, triples=None, context=None):
+        """called just before (and again just after) we send a write,
+        so the cache can drop what's affected"""
+        self._generation += 1
+        if self.cache is not None:
+            self.cache.invalidate(triples, context)
+
+    def _writeRequest(self, triples, context, **kw):
+        """_request for a write of these triples"""
+        self._graphModified(triples, context)
+        def done(ret):
+            # queries that went out while the write was in flight
+            # may have cached the old answer
+            self._graphModified(triples, context)
             return ret
-        params = {'query' : self.prologue + interpolated}
-        params.update(self.getParams)
-        return self._request(
-            "GET", path='',
-            queryParams=params,
-            headers=sendHeaders,
-            postProcess=post,
-            )
+        return self._request(postProcess=done, **kw)
         
     def queryd(self, query, initBindings={}, _postProcess=None):
         return self._getQuery(query, initBindings, _postProcess=_postProcess)
  
     def countQuery(self, query, initBindings={}, _postProcess=None):
-        # this could be ported to sparql1.1
-        def post(rows):
-            ret = len(rows)
-            if _postProcess:
-                ret = _postProcess(ret)
-            return ret
-        return self.queryd(query, initBindings, _postProcess=post)
+        """number of rows the query would return. If the server does
+        SPARQL 1.1, we only transfer the count"""
+        def countRows():
+            return self.queryd(query, initBindings, _postProcess=len)
+
+        if self.countAggregate is False or isAsk(query):
+            ret = countRows()
+        else:
+            def aggregateCount(rows):
+                count = int(rows[0]['sparqlhttpCount'])
+                self.countAggregate = True
+                return count
+            def unsupported(err):
+                if self.countAggregate or not isinstance(err,
+                                                         self._statusError):
+                    # it worked before, or the server never answered
+                    raise err
+                def rejected(count):
+                    # the plain query works, so it was the aggregate
+                    # the server couldn't do
+                    log.info("%s can't count with an aggregate (%s); "
+                             "counting rows instead", self.target, err)
+                    self.countAggregate = False
+                    return count
+                return self._then(countRows(), rejected)
+            ret = self._attempt(
+                lambda: self._getQuery(query, initBindings,
+                                       _postProcess=aggregateCount,
+                                       _wrap=sparqlCountQuery),
+                unsupported)
+        if _postProcess:
+            ret = self._then(ret, _postProcess)
+        return ret
 
     def add(self, triples, context): 
-        g = graphFromTriples(triples)
-        postData = g.serialize(format='nt')
-        
-        return self._request(method="POST", path='/statements',
-                             headers={'Content-type' : 'text/plain'},
-                             queryParams={'context': context.n3()},
-                             payload=postData)
+        return self._writeRequest(triples, context,
+                                  method="POST", path='/statements',
+                                  headers={'Content-type' : 'text/plain'},
+                                  queryParams={'context': context.n3()},
+                                  payload=encodeNTriples(triples))
+
+    def addNTriples(self, nt, context):
+        """add statements that are already N-Triples: a str, or a file
+        object to stream the request body from. Since we don't see
+        the triples, the whole cache is invalidated."""
+        return self._writeRequest(None, context,
+                                  method="POST", path='/statements',
+                                  headers={'Content-type' : 'text/plain'},
+                                  queryParams={'context': context.n3()},
+                                  payload=nt)
 
     def contains(self, stmt):
         bindings = {}
@@ -135,14 +344,42 @@ class _Graph2(object):
 
     def value(self, subj, pred, default=None, any=False):
         def justObject(rows):
-            if len(rows) == 0:
-                return default
-            if len(rows) > 1 and not any:
-                raise UniquenessError(values=[row['o'] for row in rows])
-            return rows[0]['o']
+            return _pickValue([row['o'] for row in rows], default, any)
         return self.queryd("SELECT DISTINCT ?o WHERE { ?s ?p ?o }",
                            {'s' : subj, 'p' : pred},
                            _postProcess=justObject)
+
+    batchSize = 100 # most subjects to put in one values() query
+
+    def labels(self, subjects, default=''):
+        """list of the label of each subject"""
+        return self.values(subjects, RDFS.label, default=default, any=True)
+
+    def values(self, subjects, pred, default=None, any=False):
+        """list of value(subj, pred, default, any) for each of the
+        subjects, but with one query per batchSize subjects instead of
+        one per subject"""
+        subjects = list(subjects)
+        def pick(found):
+            return [_pickValue(found.get(subj, []), default, any)
+                    for subj in subjects]
+        return self._then(self._lookup(subjects, pred), pick)
+
+    def _lookup(self, subjects, pred):
+        """{subj : [objects]} for these subjects and pred"""
+        uniq = list(set(subjects))
+        # (these are made into PreparedQuery here so the one-off query
+        # texts don't push the useful ones out of the prepare() cache)
+        results = [self.queryd(PreparedQuery(
+                       batchValueQuery(uniq[i:i + self.batchSize], pred)))
+                   for i in range(0, len(uniq), self.batchSize)]
+        def merge(chunkRows):
+            found = {}
+            for rows in chunkRows:
+                for row in rows:
+                    found.setdefault(row['s'], []).append(row['o'])
+            return found
+        return self._then(self._gather(results), merge)
     
     def subgraphLength(self, context):
         raise NotImplementedError
@@ -166,9 +403,11 @@ class _Graph2(object):
     def remove(self, triples, context=None):
         doc = transactionDoc([('remove', s, p, o, context)
                               for s, p, o in triples])
-        return self._request(method="POST", path="/statements", payload=doc,
-                             headers={'Content-Type' :
-                                      'application/x-rdftransaction'})
+        return self._writeRequest(triples, context,
+                                  method="POST", path="/statements",
+                                  payload=doc,
+                                  headers={'Content-Type' :
+                                           'application/x-rdftransaction'})
         
     def save(self, context):                  # for certain remote graphs
         log.warn("not saving %s" % context)
@@ -183,10 +422,32 @@ class SyncGraph(_Graph2):
 
     def _setRoot(self, rootUrl):
         self._resource = restkit.Resource(rootUrl)
+
+    # what _request raises when the server answers with an error status
+    _statusError = ValueError
+
+    def _succeed(self, result):
+        return result
+    def _then(self, result, func):
+        return func(result)
+    def _coalesce(self, key, call):
+        return call()
+    def _gather(self, results):
+        return list(results)
+    def _attempt(self, call, onError):
+        """call(), or onError(exception) if it raises"""
+        try:
+            return call()
+        except Exception, e:
+            return onError(e)
     def _request(self, method, path, queryParams={},
-                headers=None, payload=None, postProcess=None):
+                headers=None, payload=None, postProcess=None,
+                withResponse=False):
         """
         path is *added to* rootUrl
+
+        The result (and the postProcess input) is the response body,
+        or (status, headers, body) if you set withResponse.
         """
         url = self.target + path
 
@@ -196,18 +457,40 @@ class SyncGraph(_Graph2):
         response = self._resource.request(
             method=method, path=path, headers=headers, payload=payload,
             **queryParams)
-        if response.status_int == 204:
+        if response.status_int in (204, 304):
             # workaround for restkit, which seems to hang for a long
             # time if you request the body after a 204
             ret = None
         else:
             ret = response.body_string()
-        if not response.status.startswith('2'):
+        if not (response.status.startswith('2') or
+                response.status_int == 304):
             raise ValueError("status %s: %s" % (response.status, ret))
+        if withResponse:
+            ret = (response.status_int,
+                   dict((k.lower(), v) for k, v in response.headerslist),
+                   ret)
         if postProcess is not None:
             ret = postProcess(ret)
         return ret
 
+    def _streamRequest(self, queryParams, headers, onChunk):
+        """GET with the response body going to onChunk(str) as we
+        read it"""
+        response = self._resource.request(method="GET", path=None,
+                                          headers=headers, **queryParams)
+        if not response.status.startswith('2'):
+            raise ValueError("status %s: %s" % (response.status,
+                                                response.body_string()))
+        body = response.body_stream()
+        while True:
+            data = body.read(self.streamReadSize)
+            if not data:
+                break
+            onChunk(data)
+
+    streamReadSize = 65536
+
     # only for backwards compatibility with the old version. These
     # ought to all raise a warning
     remoteContains = makeDeferredFunc(_Graph2.contains)
@@ -230,28 +513,95 @@ class AsyncGraph(_Graph2):
     """
     def _setRoot(self, rootUrl):
         self._root = rootUrl
+        self._inFlight = SingleFlight()
+
+    _statusError = error.Error
+
+    def _succeed(self, result):
+        return defer.succeed(result)
+    def _then(self, result, func):
+        return result.addCallback(func)
+    def _coalesce(self, key, call):
+        """deferred to call(), unless a call for the same key is
+        still in flight, in which case we wait for that one's (rows,
+        keep) and get our own copy of the rows"""
+        return self._inFlight.run(key, call,
+                                  copy=lambda (rows, keep):
+                                  (_copyRows(rows), keep))
+    def _gather(self, results):
+        """deferred to the list of these deferreds' results, or to
+        the first failure"""
+        d = defer.DeferredList(results, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addCallback(lambda res: [r for ok, r in res])
+        def firstError(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        d.addErrback(firstError)
+        return d
+    def _attempt(self, call, onError):
+        """deferred to call(), or to onError(exception) if it fails"""
+        d = defer.maybeDeferred(call)
+        d.addErrback(lambda failure: onError(failure.value))
+        return d
     def _request(self, method, path, queryParams={},
-                headers=None, payload=None, postProcess=None):
+                headers=None, payload=None, postProcess=None,
+                withResponse=False, onChunk=None):
 
         url = self._root + path
-        params = self.getParams
+        params = dict(self.getParams)
         params.update(queryParams)
         if params:
             url = url + '?' + urllib.urlencode(params)
         
-        d = getPage(url, method=method, postdata=payload, headers=headers)
-
-        def notError(err):
-            # workaround for twisted treating 204 as an error
-            if err.value.status.startswith('2'):
-                return err.value.response
-            err.raiseException()
-        d.addErrback(notError)
+        if self.httpClient is None:
+            self.httpClient = defaultClient()
+        d = self.httpClient.request(method, url, headers=headers,
+                                    body=payload, onChunk=onChunk)
+        if not withResponse:
+            d.addCallback(lambda response: response[2])
 
         if postProcess is not None:
             d.addCallback(postProcess)
         return d
 
+    def _streamRequest(self, queryParams, headers, onChunk):
+        """deferred GET with the response body going to
+        onChunk(str) as it arrives"""
+        return self._request("GET", path='', queryParams=queryParams,
+                             headers=headers, onChunk=onChunk)
+
+    def value(self, subj, pred, default=None, any=False):
+        if not self.batchLookups:
+            return _Graph2.value(self, subj, pred, default, any)
+        from twisted.internet import reactor
+        if not self._pendingLookups:
+            reactor.callLater(0, self._flushLookups)
+        d = defer.Deferred()
+        self._pendingLookups.setdefault(pred, []).append(
+            (subj, default, any, d))
+        return d
+
+    def _flushLookups(self):
+        pending, self._pendingLookups = self._pendingLookups, {}
+        for pred, waiters in pending.items():
+            d = self._lookup([subj for subj, _, _, _ in waiters], pred)
+            d.addCallbacks(self._answerLookups, self._failLookups,
+                           callbackArgs=(waiters,), errbackArgs=(waiters,))
+
+    def _answerLookups(self, found, waiters):
+        for subj, default, any, d in waiters:
+            try:
+                ret = _pickValue(found.get(subj, []), default, any)
+            except UniquenessError:
+                d.errback()
+            else:
+                d.callback(ret)
+
+    def _failLookups(self, failure, waiters):
+        for subj, default, any, d in waiters:
+            d.errback(failure)
+
     # backwards compatibility. Should print warnings
     remoteContains = _Graph2.contains
     remoteLabel = _Graph2.label
@@ -262,3 +612,25 @@ class AsyncGraph(_Graph2):
         return self.add(triples, **ctx)
     def remoteRemove(self, *triples, **ctx):
         return self.remove(triples, **ctx)
+
+def _pickValue(objects, default, any):
+    """what value() returns when the subject has these objects"""
+    if len(objects) == 0:
+        return default
+    if len(objects) > 1 and not any:
+        raise UniquenessError(values=objects)
+    return objects[0]
+
+def batchValueQuery(subjects, pred):
+    """query for the ?s ?o pairs for pred on any of the subjects.
+
+    This puts the terms right in the query instead of using
+    initBindings, so caches see it as a query about no particular
+    subject.
+
+    >>> from rdflib import URIRef
+    >>> print batchValueQuery([URIRef('http://ex/a'), URIRef('http://ex/b')], URIRef('http://ex/p'))
+    SELECT DISTINCT ?s ?o WHERE { ?s <http://ex/p> ?o . FILTER ( ?s = <http://ex/a> || ?s = <http://ex/b> ) }
+    """
+    return ("SELECT DISTINCT ?s ?o WHERE { ?s %s ?o . FILTER ( %s ) }" %
+            (pred.n3(), " || ".join("?s = %s" % s.n3() for s in subjects)))
@@ -0,0 +1,153 @@
+"""
+http client for AsyncGraph and _RemoteGraph that keeps connections
+open between requests, instead of making a new one per request like
+twisted.web.client.getPage does. Needs twisted 12.1 or newer.
+
+Each connection carries one request at a time (Agent never
+pipelines), so reusing one is always safe.
+"""
+from StringIO import StringIO
+from urlparse import urlsplit
+from twisted.internet import defer, protocol
+from twisted.python.failure import Failure
+from twisted.web import error
+from twisted.web.client import (Agent, HTTPConnectionPool, FileBodyProducer,
+                                ResponseDone)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+class CountingConnectionPool(HTTPConnectionPool):
+    """HTTPConnectionPool that counts how many connections it had to
+    open, and how many requests got an idle connection instead"""
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.opened = 0
+        self.reused = 0
+
+    def getConnection(self, key, endpoint):
+        opened = self.opened
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.opened == opened:
+            self.reused += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.opened += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+class PooledHttpClient(object):
+    def __init__(self, maxPerHost=8, idleTimeout=60):
+        """
+        maxPerHost is how many requests may be running on one host at
+        once; the rest wait their turn. That's also how many idle
+        connections are kept per host, each for up to idleTimeout
+        seconds.
+        """
+        from twisted.internet import reactor
+        self.pool = CountingConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = maxPerHost
+        self.pool.cachedConnectionTimeout = idleTimeout
+        self.agent = Agent(reactor, pool=self.pool)
+        self.maxPerHost = maxPerHost
+        self._hostLimits = {} # (scheme, netloc) : DeferredSemaphore
+        self.requests = 0
+
+    def request(self, method, url, headers=None, body=None, onChunk=None):
+        """deferred to (status, headers, body), where status is an int
+        and headers is a dict of lowercase name : first value.
+
+        Statuses other than 2xx and 304 errback with
+        twisted.web.error.Error, the same error getPage gives.
+
+        headers is a dict of name : value to send. body is an
+        optional str, or a file object to stream the body from.
+
+        If you pass onChunk, a successful response's body goes to
+        onChunk(str) piece by piece as it arrives, and the body in
+        the result is ''.
+        """
+        self.requests += 1
+        sendHeaders = Headers()
+        for k, v in (headers or {}).items():
+            sendHeaders.setRawHeaders(k, [v])
+        producer = None
+        if body is not None:
+            if not hasattr(body, 'read'):
+                body = StringIO(body)
+            producer = FileBodyProducer(body)
+        scheme, netloc = urlsplit(url)[:2]
+        limit = self._hostLimits.get((scheme, netloc))
+        if limit is None:
+            limit = self._hostLimits[(scheme, netloc)] = \
+                    defer.DeferredSemaphore(self.maxPerHost)
+        return limit.run(self._request, method, str(url), sendHeaders,
+                         producer, onChunk)
+
+    def _request(self, method, url, headers, producer, onChunk):
+        d = self.agent.request(method, url, headers, producer)
+        @d.addCallback
+        def gotResponse(response):
+            collected = defer.Deferred()
+            chunkSink = onChunk
+            if not 200 <= response.code < 300:
+                chunkSink = None # collect the error body instead
+            response.deliverBody(_BodyCollector(collected, chunkSink))
+            collected.addCallback(lambda body:
+                                  _checkStatus(response, body))
+            return collected
+        return d
+
+    def stats(self):
+        """dict of the connection counters"""
+        return dict(requests=self.requests,
+                    connectionsOpened=self.pool.opened,
+                    connectionsReused=self.pool.reused)
+
+    def close(self):
+        """deferred that fires when the idle connections are closed"""
+        return self.pool.closeCachedConnections()
+
+def _checkStatus(response, body):
+    code = response.code
+    headers = dict((k.lower(), v[0]) for k, v in
+                   response.headers.getAllRawHeaders())
+    if 200 <= code < 300 or code == 304:
+        return code, headers, body
+    raise error.Error(str(code), response.phrase, body)
+
+class _BodyCollector(protocol.Protocol):
+    def __init__(self, finished, onChunk=None):
+        self.finished = finished
+        self.onChunk = onChunk
+        self.chunks = []
+        self.failed = None
+
+    def dataReceived(self, data):
+        if self.failed is not None:
+            return
+        if self.onChunk is None:
+            self.chunks.append(data)
+            return
+        try:
+            self.onChunk(data)
+        except Exception:
+            # drop the rest of the body; connectionLost reports this
+            self.failed = Failure()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.failed is not None:
+            self.finished.errback(self.failed)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+_defaultClient = None
+def defaultClient():
+    """the PooledHttpClient that graphs share if you don't give them
+    one of their own"""
+    global _defaultClient
+    if _defaultClient is None:
+        _defaultClient = PooledHttpClient()
+    return _defaultClient
@@ -0,0 +1,153 @@
+"""
+N-Triples in batches, for loading big files without holding them in
+memory. readNTriples reads a file-like object a block at a time and
+hands you the parsed statements every batchSize of them.
+
+lineChunks and ChunkTracker are for uploading a file in pieces
+without parsing it at all (see bin/graphimport --bulk).
+
+encodeNTriples goes the other way, from (s,p,o) tuples straight to
+N-Triples text, without building an rdflib Graph to serialize.
+"""
+import re
+from rdflib import URIRef, BNode, Literal
+try:
+    from rdflib.syntax.parsers.ntriples import NTriplesParser, ParseError
+except ImportError:
+    #rdflib3
+    from rdflib.plugins.parsers.ntriples import NTriplesParser, ParseError
+
+class _BatchSink(object):
+    """NTriplesParser sink that collects statements and passes them on
+    in lists of batchSize"""
+    def __init__(self, onBatch, batchSize):
+        self.onBatch = onBatch
+        self.batchSize = batchSize
+        self.batch = []
+        self.count = 0
+
+    def triple(self, s, p, o):
+        self.batch.append((s, p, o))
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self.count += len(batch)
+            self.onBatch(batch)
+
+def readNTriples(f, onBatch, batchSize=10000):
+    """parse the N-Triples in file-like object f, calling
+    onBatch(list of (s,p,o)) for every batchSize statements and once
+    more for the rest. Returns the number of statements.
+
+    A ParseError stops the read, but the batches before it have
+    already been passed to onBatch. Blank node labels are consistent
+    over the whole file."""
+    sink = _BatchSink(onBatch, batchSize)
+    NTriplesParser(sink).parse(f)
+    sink.flush()
+    return sink.count
+
+def lineChunks(f, chunkBytes=1000000, offset=0):
+    """split file f (opened in binary mode) into pieces of about
+    chunkBytes that end at line ends, without parsing them. Yields
+    (start offset, text). Reading starts at byte offset, which should
+    be the start of a line, like a ChunkTracker.safeOffset."""
+    f.seek(offset)
+    while True:
+        text = f.read(chunkBytes)
+        if not text:
+            return
+        if not text.endswith('\n'):
+            text += f.readline()
+        yield offset, text
+        offset += len(text)
+
+class ChunkTracker(object):
+    """follows the lineChunks of a file that are being uploaded,
+    possibly finishing out of order. safeOffset is where a restart
+    should begin: every byte before it is done."""
+    def __init__(self, offset=0):
+        self.safeOffset = offset
+        self.bytesDone = 0
+        self.pending = {} # start : end, for chunks still going
+        self.done = {} # start : end, for chunks done after safeOffset
+
+    def started(self, start, length):
+        self.pending[start] = start + length
+
+    def finished(self, start):
+        end = self.pending.pop(start)
+        self.bytesDone += end - start
+        self.done[start] = end
+        while self.safeOffset in self.done:
+            self.safeOffset = self.done.pop(self.safeOffset)
+
+def encodeNTriples(triples):
+    """N-Triples text (an ascii str) for an iterable of (s,p,o)"""
+    return ''.join(nTriplesChunks(triples))
+
+def nTriplesChunks(triples, chunkLines=1000):
+    """the encodeNTriples text in pieces of about chunkLines lines
+    each, pulling triples only as the pieces are needed"""
+    terms = {} # URIRef : its text, since the same ones come up a lot
+    out = []
+    for stmt in triples:
+        for term in stmt:
+            if type(term) is URIRef:
+                try:
+                    out.append(terms[term])
+                except KeyError:
+                    out.append(terms.setdefault(term, ntTerm(term)))
+            else:
+                out.append(ntTerm(term))
+            out.append(' ')
+        out.append('.\n')
+        if len(out) >= chunkLines * 7:
+            yield ''.join(out)
+            out = []
+    if out:
+        yield ''.join(out)
+
+def ntTerm(term):
+    """N-Triples text for one URIRef, BNode or Literal"""
+    if isinstance(term, URIRef):
+        return '<%s>' % _escape(term)
+    if isinstance(term, BNode):
+        return '_:%s' % str(term)
+    if isinstance(term, Literal):
+        if term.language:
+            return '"%s"@%s' % (_escape(term), str(term.language))
+        if term.datatype is not None:
+            return '"%s"^^<%s>' % (_escape(term), _escape(term.datatype))
+        return '"%s"' % _escape(term)
+    raise TypeError("can't write %r as N-Triples" % (term,))
+
+# everything but the printable ascii that can be written as it is.
+# (A narrow python build has the characters past U+FFFF as pairs.)
+_needsEscape = re.compile(u'[\ud800-\udbff][\udc00-\udfff]|'
+                          u'[^\\x20\\x21\\x23-\\x5b\\x5d-\\x7e]')
+_escapes = {u'\\' : '\\\\', u'"' : '\\"', u'\n' : '\\n',
+            u'\r' : '\\r', u'\t' : '\\t'}
+
+def _escapeChar(match):
+    c = match.group()
+    try:
+        return _escapes[c]
+    except KeyError:
+        pass
+    if len(c) == 2:
+        n = 0x10000 + ((ord(c[0]) - 0xd800) << 10) + ord(c[1]) - 0xdc00
+    else:
+        n = ord(c)
+    if n > 0xffff:
+        return '\\U%08X' % n
+    return '\\u%04X' % n
+
+def _escape(text):
+    """ascii str of text with N-Triples string escapes"""
+    if _needsEscape.search(text) is None:
+        return str(text)
+    return str(_needsEscape.sub(_escapeChar, text))
@@ -1,19 +1,18 @@
-import urllib, warnings, inspect, os, hashlib, re, logging
+import urllib, warnings, inspect, os, re, logging
 from twisted.internet import defer
-from twisted.web.client import getPage
+from twisted.python.failure import Failure
+from twisted.web import error
 from rdflib import Variable, RDFS, Literal
 from rdflib.exceptions import UniquenessError
-try:
-    from rdflib.Graph import Graph
-except ImportError:
-    from rdflib import Graph
-from sparqlhttp.sparqlxml import parseSparqlResults, parseCountTree
-from sparqlhttp.sparqljson import parseJsonResults, jsonRowCount
-from sparqlhttp.dictquery import sparqlSelection
-try:
-    from xml.etree import ElementTree
-except ImportError:
-    from elementtree import ElementTree
+from sparqlhttp.sparqlxml import (iterParseSparqlResults, countSparqlResults,
+                                  XmlResultsParser)
+from sparqlhttp.sparqljson import (parseJsonResults, jsonRowCount,
+                                   JsonResultsParser)
+from sparqlhttp.dictquery import (sparqlSelection, PreparedQuery,
+                                  PreparedQueries, splitPrologue, _askQuery)
+from sparqlhttp.cache import LRUCache, Miss, TermInterner
+from sparqlhttp.httpclient import defaultClient
+from sparqlhttp.ntriples import encodeNTriples
 log = logging.getLogger("remotegraph")
 
 # every http request to the server would print "Stopping factory" and
@@ -36,7 +35,9 @@ class _RemoteGraph(object):
     
     """
     def __init__(self, serverUrl, initNs=None, sendSourceLine=False,
-                 resultFormat='json'):
+                 resultFormat='json', etagCacheSize=200,
+                 countAggregate=None, httpClient=None, compactRows=False,
+                 termCacheSize=10000):
         """
         turn on sendSourceLine and the client will put an
         x-source-line header in every request. The server report shows
@@ -47,6 +48,28 @@ class _RemoteGraph(object):
 
         resultFormat can be 'xml' or 'json'. We'll ask the server for
         that format and then parse it here.
+
+        etagCacheSize is how many remoteQueryd results to remember
+        along with their ETags. Asking one of those queries again
+        sends If-None-Match, and if the server says 304 Not Modified
+        we return the remembered rows. 0 turns this off.
+
+        countAggregate says whether the server can do SPARQL 1.1
+        COUNT(*), which lets remoteCountQuery get just the count. None
+        means try it once and remember whether it worked.
+
+        httpClient is the sparqlhttp.httpclient.PooledHttpClient that
+        keeps our connections to the server open between
+        requests. The default is one shared by all graphs.
+
+        compactRows makes remoteQueryd return sparqlhttp.rows.Row
+        objects instead of dicts. They take much less memory, but
+        they can't be changed.
+
+        termCacheSize is how many distinct URIs and literals to share
+        between all the results we parse (see
+        sparqlhttp.cache.TermInterner). 0 means only share them
+        within each result.
         
         """
         self.sendSourceLine = sendSourceLine
@@ -57,7 +80,20 @@ class _RemoteGraph(object):
         if initNs:
             self.prologue = "".join("PREFIX %s: <%s>\n" % (pre,full)
                                     for (pre,full) in initNs.items())
-
+        self._etags = None
+        if etagCacheSize:
+            self._etags = LRUCache(etagCacheSize) # request : (etag, rows)
+        self.countAggregate = countAggregate
+        if httpClient is None:
+            httpClient = defaultClient()
+        self.httpClient = httpClient
+        self._inFlight = SingleFlight()
+        self._generation = 0 # bumped on every write we make
+        self.compactRows = compactRows
+        self.terms = None
+        if termCacheSize:
+            self.terms = TermInterner(termCacheSize)
+        self._prepared = PreparedQueries(check=self._checkQuerySyntax)
 
     # when searching for the code that made calls to RemoteGraph,
     # ignore any filenames in this list. (When subclassing, add your
@@ -83,8 +119,15 @@ class _RemoteGraph(object):
 
     def _serverGet(self, request, headers=None):
         """deferred to the result of GET {serverUrl}{request}"""
-        return getPage(self.serverUrl + request,
-                       headers=self._withSourceLineHeaders(headers))
+        d = self._serverGetResponse(request, headers)
+        d.addCallback(lambda response: response[2])
+        return d
+
+    def _serverGetResponse(self, request, headers=None):
+        """deferred to (status, headers, body) of GET {serverUrl}{request}"""
+        return self.httpClient.request(
+            'GET', self.serverUrl + request,
+            headers=self._withSourceLineHeaders(headers))
 
     def _withSourceLineHeaders(self, headers):
         _headers = {}
@@ -102,14 +145,29 @@ class _RemoteGraph(object):
     def _checkQuerySyntax(self, query):
         return _checkQuerySyntax(query)
 
+    def prepare(self, query):
+        """PreparedQuery for this query text, which you can pass to
+        remoteQueryd or remoteCountQuery in place of the text"""
+        return self._prepared.prepare(query)
+
     def _getQuery(self, query, initBindings, headers=None):
         """send this query to the server, return deferred to the raw
         server result. This is where the prologue (@PREFIX lines) is added."""
-        self._checkQuerySyntax(query)
+        get, sendHeaders = self._queryRequest(query, initBindings, headers)
+        d = self._serverGet(get, headers=sendHeaders)
+        return d
+
+    def _queryRequest(self, query, initBindings, headers=None, wrap=None):
+        """the (path, headers) for a GET of this query. wrap is an
+        optional function to apply to the interpolated query, like
+        sparqlCountQuery"""
+        query = self.prepare(query)
         try:
+            interpolated = query.interpolate(initBindings)
+            if wrap is not None:
+                interpolated = wrap(interpolated)
             get = ('?query=' +
-                   urllib.quote(self.prologue +
-                                interpolateSparql(query, initBindings), safe=''))
+                   urllib.quote(self.prologue + interpolated, safe=''))
         except Exception:
             log.error("original query=%r, initBindings=%r" %
                       (query, initBindings))
@@ -123,7 +181,7 @@ class _RemoteGraph(object):
         xBindings = (" ".join(initBindings.keys())).encode('utf8')
 
         sendHeaders = {'x-uninterpolated-query-checksum' :
-                       hashlib.md5(query).hexdigest(),
+                       query.checksum,
                        'x-bindings' : xBindings,
                        }
         if self.resultFormat == 'json':
@@ -133,23 +191,120 @@ class _RemoteGraph(object):
             
         if headers:
             sendHeaders.update(headers)
-        
-        d = self._serverGet(get, headers=sendHeaders)
-        return d
+        return get, sendHeaders
         
     def remoteQueryd(self, query, initBindings={}):
-        d = self._getQuery(query, initBindings)
+        return self._queryRows(query, initBindings)
+
+    def queryStream(self, query, initBindings={}, onRows=None):
+        """like remoteQueryd, but the rows go to onRows(rows) a batch
+        at a time as they arrive from the server, in either result
+        format, so a huge result never has to be in memory all at
+        once. Deferred to the number of rows, which fires after the
+        last onRows call. ASK queries aren't supported.
+
+        (This is AsyncGraph.queryStream for this older class. There's
+        no LocalGraph version.)"""
+        query = self.prepare(query)
+        get, sendHeaders = self._queryRequest(query, initBindings)
         if self.resultFormat == 'json':
-            d.addCallback(parseJsonResults)
+            parser = JsonResultsParser(self.compactRows,
+                                       query.variables or None, self.terms)
         else:
-            d.addCallback(parseSparqlResults)
-        d.addCallback(self._addOptionalVars, query)
+            parser = XmlResultsParser(self.compactRows,
+                                      query.variables or None, self.terms)
+        count = [0]
+        def onChunk(data):
+            rows = parser.feed(data)
+            if rows:
+                count[0] += len(rows)
+                if not self.compactRows:
+                    rows = self._addOptionalVars(rows, query)
+                onRows(rows)
+        d = self.httpClient.request(
+            'GET', self.serverUrl + get,
+            headers=self._withSourceLineHeaders(sendHeaders), onChunk=onChunk)
+        @d.addCallback
+        def done(_):
+            parser.close()
+            return count[0]
+        return d
+
+    def _queryRows(self, query, initBindings, wrap=None):
+        query = self.prepare(query)
+        get, sendHeaders = self._queryRequest(query, initBindings, wrap=wrap)
+        etagKey = (get, sendHeaders['Accept'])
+        # callers asking for the same query while it's already on its
+        # way wait for that answer instead of sending it again (but a
+        # query sent before one of our writes doesn't answer for
+        # after it)
+        return self._inFlight.run(
+            (self._generation, etagKey),
+            lambda: self._fetchRows(query, get, sendHeaders, etagKey))
+
+    def _fetchRows(self, query, get, sendHeaders, etagKey):
+        held = Miss
+        if self._etags is not None:
+            held = self._etags.get(etagKey)
+            if held is not Miss:
+                sendHeaders['If-None-Match'] = held[0]
+        d = self._serverGetResponse(get, headers=sendHeaders)
+
+        @d.addCallback
+        def parse(response):
+            status, headers, body = response
+            if status == 304 and held is not Miss:
+                return _copyRows(held[1])
+            variables = query.variables or None
+            if self.resultFormat == 'json':
+                rows = parseJsonResults(body, self.compactRows, variables,
+                                        self.terms)
+            else:
+                rows = iterParseSparqlResults(body, self.compactRows,
+                                              variables, self.terms)
+                if not isinstance(rows, bool):
+                    rows = list(rows)
+            if not (self.compactRows or
+                    isinstance(rows, bool)): # ASK result
+                rows = self._addOptionalVars(rows, query)
+            if self._etags is not None and headers.get('etag'):
+                self._etags.set(etagKey, (headers['etag'], rows))
+                return _copyRows(rows)
+            return rows
         return d
 
     def _addOptionalVars(self, rows, query):
         return _addOptionalVars(rows, query)
 
     def remoteCountQuery(self, query, initBindings={}):
+        if self.countAggregate is False or isAsk(query):
+            return self._hintedCountQuery(query, initBindings)
+
+        d = self._queryRows(query, initBindings, wrap=sparqlCountQuery)
+        @d.addCallback
+        def supported(rows):
+            count = int(rows[0]['sparqlhttpCount'])
+            self.countAggregate = True
+            return count
+        @d.addErrback
+        def unsupported(err):
+            if self.countAggregate or not err.check(error.Error):
+                # it worked before, or the server never answered
+                return err
+            counted = self._hintedCountQuery(query, initBindings)
+            @counted.addCallback
+            def rejected(count):
+                # the plain query works, so it was the aggregate the
+                # server couldn't do
+                log.info("%s can't count with an aggregate (%s); using "
+                         "the count hint instead", self.serverUrl,
+                         err.getErrorMessage())
+                self.countAggregate = False
+                return count
+            return counted
+        return d
+
+    def _hintedCountQuery(self, query, initBindings):
         # hint the server that it can return just a count (but if it
         # doesn't get the hint, we'll still count the result rows)
         d = self._getQuery(query, initBindings,
@@ -158,28 +313,33 @@ class _RemoteGraph(object):
         @d.addCallback
         def checkType(result):
             if self.resultFormat == 'json':
-                # virtuoso can do an aggregate query and give just the
-                # count, but I haven't implemented that yet.
+                # a sparqlhttp server sends a json count; others
+                # send all the rows
                 return jsonRowCount(result)
-            
-            tree = ElementTree.fromstring(result)
-            # if it's pre-counted, return that
-            try:
-                return parseCountTree(tree)
-            except ValueError:
-                # server didn't get our hint, so it returned all the rows
-                rows = parseSparqlResults(tree)
-                return len(rows)
+
+            # either the pre-counted result, or all the rows if the
+            # server didn't get our hint
+            return countSparqlResults(result)
         return d
 
     def remoteAdd(self, *triples, **context):
         if 'context' not in context:
             raise TypeError("must pass 'context' kw arg")
-        post = self.serverUrl.rstrip('/') + '/statements?context=%s' % urllib.quote(context['context'].n3(), safe='')
-        return self._postWithTriples(post, triples)
+        return self._postWithTriples(self._statementsUrl(context['context']),
+                                     triples)
+
+    def addNTriples(self, nt, context):
+        """like remoteAdd, but for statements that are already N-Triples:
+        a str, or a file object to stream the request body from"""
+        return self._deferredPost(self._statementsUrl(context), nt)
+
+    def _statementsUrl(self, context):
+        return self.serverUrl.rstrip('/') + '/statements?context=%s' % urllib.quote(context.n3(), safe='')
 
     def remoteSave(self, context):
-        d = getPage(self.serverUrl.rstrip('/') + '/save?context=' + urllib.quote(context))
+        d = self.httpClient.request(
+            'GET', self.serverUrl.rstrip('/') + '/save?context=' + urllib.quote(context))
+        d.addCallback(lambda response: response[2])
         return d
 
     def remoteContains(self, stmt):
@@ -222,28 +382,64 @@ class _RemoteGraph(object):
         return self._postWithTriples(post, triples, method="DELETE")
         
     def _postWithTriples(self, url, triples, method='POST'):
-        g = graphFromTriples(triples)
-        postData = g.serialize(format='nt')
-        return self._deferredPost(url, postData, method)
+        return self._deferredPost(url, encodeNTriples(triples), method)
 
     def _deferredPost(self, url, postData, method='POST'):
-        d = getPage(url, method=method, postdata=postData,
-                    headers={'Content-Type' : 'text/plain'})
-        def notError(err):
-            # workaround for twisted treating 204 as an error
-            if err.value.status.startswith('2'):
-                return err.value.response
-            err.raiseException()
-        d.addErrback(notError)
+        self._generation += 1
+        d = self.httpClient.request(method, url, body=postData,
+                                    headers={'Content-Type' : 'text/plain'})
+        @d.addCallback
+        def done(response):
+            # queries that went out while the write was in flight
+            # may get the old answer
+            self._generation += 1
+            return response[2]
         return d
                   
 
-def graphFromTriples(triples):
-    g = Graph()
-    for stmt in triples:
-        g.add(stmt)
-    return g
-            
+class SingleFlight(object):
+    """runs at most one call per key at a time. Whoever asks for a
+    key that's already running gets a deferred to that call's result
+    (or failure) instead of starting another one."""
+    def __init__(self):
+        self._waiting = {} # key : [deferreds for the callers]
+        self.calls = self.coalesced = 0
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def run(self, key, call, copy=None):
+        """deferred to the result of call(), which returns a
+        deferred. The first caller for a key gets the result itself
+        and the rest get copy(result); the default copy is _copyRows."""
+        d = defer.Deferred()
+        if key in self._waiting:
+            self.coalesced += 1
+            self._waiting[key].append(d)
+            return d
+        self.calls += 1
+        waiters = self._waiting[key] = [d]
+        if copy is None:
+            copy = _copyRows
+        def fire(result):
+            del self._waiting[key]
+            if isinstance(result, Failure):
+                for w in waiters:
+                    w.errback(result)
+                return
+            # copy before anyone's callbacks get to change the result
+            results = [result] + [copy(result) for w in waiters[1:]]
+            for w, r in zip(waiters, results):
+                w.callback(r)
+        defer.maybeDeferred(call).addBoth(fire)
+        return d
+
+def _copyRows(rows):
+    """rows that the caller can change without affecting ours"""
+    if isinstance(rows, bool):
+        return rows
+    # (a compact Row can't be changed, so its copy is itself)
+    return [row.copy() for row in rows]
 
 def makeDeferredFunc(func):
     """wrapper for func that makes it return a deferred"""
@@ -265,6 +461,9 @@ class LocalGraph(object):
         self.graph = graph
         self.setupLocalMethods()
 
+    def prepare(self, query):
+        return self.graph.prepare(query)
+
     graphAccessFilenames = []
 
     def setupLocalMethods(self):
@@ -323,6 +522,38 @@ def interpolateSparql(query, initBindings):
 #    print "Expand to", query
     return query 
 
+def sparqlCountQuery(query):
+    """SPARQL 1.1 query for the number of rows the given (already
+    interpolated) SELECT would return, as ?sparqlhttpCount. The spaces inside
+    the parens are so sparqlSelection still finds ?sparqlhttpCount.
+
+    A subquery can't have PREFIX, BASE or FROM, so the given query's
+    own ones go on the outer query.
+
+    >>> sparqlCountQuery('SELECT DISTINCT ?x WHERE { ?x ?y ?z }')
+    'SELECT ( COUNT(*) AS ?sparqlhttpCount ) WHERE { SELECT DISTINCT ?x WHERE { ?x ?y ?z } }'
+    >>> print sparqlCountQuery('PREFIX ex: <http://ex/>\\nSELECT ?x FROM <http://ex/g> FROM NAMED ex:h WHERE { ?x ?y ?z }')
+    PREFIX ex: <http://ex/>
+    SELECT ( COUNT(*) AS ?sparqlhttpCount ) FROM <http://ex/g> FROM NAMED ex:h WHERE { SELECT ?x WHERE { ?x ?y ?z } }
+    """
+    prologue, query = splitPrologue(query)
+    brace = query.find('{')
+    if brace == -1:
+        brace = len(query)
+    head = query[:brace]
+    datasets = ''.join(m.group().strip() + ' '
+                       for m in _datasetClause.finditer(head))
+    return "%sSELECT ( COUNT(*) AS ?sparqlhttpCount ) %sWHERE { %s }" % (
+        prologue, datasets, _datasetClause.sub('', head) + query[brace:])
+
+# FROM <g> or FROM NAMED <g>, with a <uri> or a prefixed name
+_datasetClause = re.compile(r'\s*\bFROM\s+(NAMED\s+)?(<[^>]*>|\S+)', re.I)
+
+def isAsk(query):
+    if isinstance(query, PreparedQuery):
+        query = query.query
+    return _askQuery.match(query) is not None
+
 def _checkQuerySyntax(query):
     if query == 'SELECT * WHERE { ?s ?p ?o. }':
         return
@@ -342,7 +573,11 @@ def _addOptionalVars(rows, query):
 
     rows are edited in-place, and then returned.
     """
-    vars = [v.strip('?') for v in sparqlSelection(query)]
+    if isinstance(query, PreparedQuery):
+        selection = query.selection
+    else:
+        selection = sparqlSelection(query)
+    vars = [v.strip('?') for v in selection]
     for row in rows:
         for v in vars:
             if v not in row:
@@ -0,0 +1,98 @@
+"""
+compact result rows. The parsers make these instead of dicts when you
+pass compact=True (and graphs do when you give them compactRows=True).
+
+A Row reads like the dict it replaces (row['x'], row.get('x'), keys,
+items, == against a dict), but it's a tuple of values plus a Header
+that all the rows of one result share, so it's several times smaller.
+Every selected variable is a key; the unbound ones are None, like
+_addOptionalVars in remotegraph.py makes them. Rows can't be changed,
+so row.copy() is the row itself.
+"""
+
+class Header(object):
+    """the variable names of a result, in order"""
+    __slots__ = ['names', 'index']
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = dict((n, i) for i, n in enumerate(self.names))
+
+    def __repr__(self):
+        return 'Header(%r)' % (self.names,)
+
+class Row(object):
+    __slots__ = ['_header', '_values']
+    def __init__(self, header, values):
+        self._header = header
+        self._values = values
+
+    def __getitem__(self, name):
+        return self._values[self._header.index[name]]
+
+    def get(self, name, default=None):
+        try:
+            i = self._header.index[name]
+        except KeyError:
+            return default
+        return self._values[i]
+
+    def __contains__(self, name):
+        return name in self._header.index
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._header.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._header.names)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._header.names, self._values)
+
+    def copy(self):
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = dict(other.items())
+        if not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None # equal to dicts, which aren't hashable
+
+    def __repr__(self):
+        return 'Row(%r)' % dict(self.items())
+
+class RowMaker(object):
+    """makes the Rows of one result. variables is the list of
+    selected names (without '?'), if you know it; bindings for other
+    names get added to the header as they turn up."""
+    def __init__(self, variables=()):
+        self.header = Header(variables)
+
+    def row(self, bindings):
+        """Row for a dict of name : term"""
+        header = self.header
+        values = [None] * len(header.names)
+        index = header.index
+        for k, v in bindings.items():
+            try:
+                values[index[k]] = v
+            except KeyError:
+                self.header = Header(header.names + tuple(
+                    k for k in bindings if k not in index))
+                return self.row(bindings)
+        return Row(header, tuple(values))
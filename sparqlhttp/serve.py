@@ -1,11 +1,19 @@
 from __future__ import division
-import traceback, time, logging, warnings
+import traceback, time, logging, warnings, hashlib, os
 from twisted.web import http
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import reactor, defer, threads
+from twisted.internet.task import cooperate, TaskStopped
+from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
 from rdflib import Literal, URIRef
-from rdflib.Graph import Graph
-from sparqlhttp.sparqlxml import xmlResults, xmlCountResults
+from sparqlhttp.sparqlxml import fastXmlResults, xmlResultsChunks, xmlCountResults, xmlAskResult
+from sparqlhttp.sparqljson import jsonResults, jsonResultsChunks, jsonAskResult, jsonCountResults
+from sparqlhttp.dictquery import sparqlSelection
 from sparqlhttp.stats import Stats
+from sparqlhttp.cache import LRUCache, Miss
+from sparqlhttp.ntriples import readNTriples
 
 log = logging.getLogger("sparqlserve")
 
@@ -22,9 +30,64 @@ class SPARQLResource(Resource):
     DELETE /?context={uri}   drop this context
     """
     isLeaf = True
-    def __init__(self, graph):
+    def __init__(self, graph, streamChunkRows=None, queryThreads=0,
+                 maxQueuedQueries=100, responseCacheSize=100,
+                 maxCachedBodyBytes=1000000, ingestBatchSize=10000):
+        """
+        streamChunkRows: if set, SELECT results are written to the
+        client in pieces of this many rows as they get serialized,
+        instead of as one string at the end. Use this if you serve
+        big results. The result dicts and the serialized text are
+        made a piece at a time, but rdflib still evaluates the whole
+        query (and holds its result) before the first row goes out.
+
+        queryThreads: if nonzero, queries are evaluated and
+        serialized in a pool of this many threads instead of in the
+        reactor, so a slow query doesn't hold up the other
+        clients. Any number of queries may run together, but /add,
+        /remove and /save wait for the running queries (including
+        streamed ones, until they're all sent) and run alone.
+
+        maxQueuedQueries: with queryThreads, once this many queries
+        are waiting or running, new ones get 503 Service Unavailable.
+
+        responseCacheSize: how many serialized responses to keep, so
+        a repeated query is answered without evaluating it. Bodies
+        over maxCachedBodyBytes are not kept. Entries are good until
+        the graph's generation changes (see Graph2._graphModified);
+        graphs without a generation get no cache.
+
+        Query responses from a graph with a generation also carry an
+        ETag, and a request whose If-None-Match has the current one
+        gets 304 Not Modified without evaluating anything.
+
+        ingestBatchSize: /add and /remove read the posted N-Triples
+        a block at a time and write them to the graph in batches of
+        this many statements, so a big upload is never all in memory
+        at once. If the body has a syntax error partway, the batches
+        before it are already written.
+        """
         self.graph = graph
         self.stats = Stats()
+        self.streamChunkRows = streamChunkRows
+        self.maxQueuedQueries = maxQueuedQueries
+        self.threadPool = None
+        self.lock = ReadWriteLock()
+        self._queuedQueries = 0
+        self.responseCache = None
+        if responseCacheSize and hasattr(graph, 'generation'):
+            self.responseCache = ResponseCache(graph, responseCacheSize)
+            self.stats.responseCache = self.responseCache
+        self.maxCachedBodyBytes = maxCachedBodyBytes
+        self.ingestBatchSize = ingestBatchSize
+        # so a restarted server doesn't match the old ETags
+        self._etagSalt = os.urandom(8).encode('hex')
+        if queryThreads:
+            self.threadPool = ThreadPool(minthreads=0, maxthreads=queryThreads,
+                                         name="sparqlhttp queries")
+            self.threadPool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.threadPool.stop)
 
     def render_GET(self, request):
         # see http://twistedmatrix.com/projects/web/documentation/howto/using-twistedweb.html#rendering
@@ -35,39 +98,185 @@ class SPARQLResource(Resource):
         
         if request.path == '/save':
             warnings.warn('Use POST for /save requests', DeprecationWarning)
-            return self.getSave(request)
+            return self._runWrite(request, self.getSave, request)
         
         request.setResponseCode(http.BAD_REQUEST)
         return "<html>Invalid request: this is a sparql query server</html>"
 
     def getQuery(self, request):
-        """GET /?query=SELECT... returns sparql results in xml"""
+        """GET /?query=SELECT... returns sparql results in xml, or in
+        json if the Accept header asks for it"""
         query = request.args['query'][0]
         log.debug("received query: %r", query)
+        wantJson = acceptsJson(request)
         isCount = request.getHeader('x-stat-result') == 'count'
         
         self.stats.queries += 1
+        self.stats.lastQuery = query
         t1 = time.time()
-        try:
-            self.stats.lastQuery = query
-            if isCount:
-                count = self.graph.countQuery(query)
-            else:
-                results = self.graph.queryd(query)
-        except Exception, e:
-            self.stats.lastErrorQuery = query
-            self.stats.lastError = traceback.format_exc()
-            log.debug("query error: %s", self.stats.lastError)
-            raise
-
-        if not isCount:
+
+        generation = getattr(self.graph, 'generation', None)
+        etag = None
+        if generation is not None:
+            etag = self._etag(generation, query, wantJson, isCount)
+            if etagMatches(request, etag):
+                request.setResponseCode(http.NOT_MODIFIED)
+                request.setHeader('ETag', etag)
+                return ''
+
+        cacheKey = None
+        if self.responseCache is not None:
+            cacheKey = (query, wantJson, isCount)
+            cached = self.responseCache.get(cacheKey)
+            if cached is not Miss:
+                generation, contentType, body, rowCount = cached
+                request.setHeader('ETag', etag)
+                return self._respond(request, query, t1,
+                                     (contentType, body, [rowCount]))
+
+        def respond(response):
+            if etag is not None:
+                request.setHeader('ETag', etag)
+            if cacheKey is not None:
+                response = self._cacheResponse(cacheKey, generation, response)
+            return self._respond(request, query, t1, response)
+
+        if self.threadPool is None:
             try:
-                results = list(results)
-                count = len(results)
-                log.debug("got %s rows", count)
-            except TypeError,e:
-                count = 0 # this bogus value only affects the stats
+                response = self._evaluate(query, isCount, wantJson)
+            except Exception, e:
+                self._queryFailed(query, traceback.format_exc())
+                raise
+            ret = respond(response)
+            if isinstance(ret, defer.Deferred): # streaming
+                return NOT_DONE_YET
+            return ret
+
+        if self._queuedQueries >= self.maxQueuedQueries:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            return "<html>too many queries are waiting; try again later</html>"
+        self._queuedQueries += 1
+        def evaluate():
+            d = threads.deferToThreadPool(reactor, self.threadPool,
+                                          self._evaluate, query, isCount,
+                                          wantJson)
+            @d.addBoth
+            def dequeue(result):
+                self._queuedQueries -= 1
+                return result
+            # (a streamed response fires this when it's all sent, so
+            # we keep the read lock while its rows are evaluated)
+            d.addCallback(respond)
+            d.addErrback(lambda err:
+                         self._queryFailed(query, err.getTraceback()) or err)
+            return d
+        return self._finishLater(request, self.lock.runRead(evaluate))
+
+    def _etag(self, generation, query, wantJson, isCount):
+        """strong ETag for this query's response at this generation"""
+        return '"%s"' % hashlib.md5("%s %s %s %s %s" % (
+            self._etagSalt, generation, wantJson, isCount,
+            query)).hexdigest()
+
+    def _evaluate(self, query, isCount, wantJson):
+        """run the query and serialize the result. This is the part
+        that runs in the thread pool, if there is one.
+
+        Returns (contentType, body, rowCount), where body is a str,
+        or an iterator of strs for results that will be streamed.
+        rowCount is a one-item list, which streamed results keep
+        updating as they go."""
+        if isCount:
+            count = self.graph.countQuery(query)
+            if wantJson:
+                return ('application/sparql-results+json',
+                        jsonCountResults(count), [count])
+            return ('application/sparql-results+xml', xmlCountResults(count),
+                    [count])
+
+        results = self.graph.queryd(query)
+        if isinstance(results, bool): # ASK
+            if wantJson:
+                return 'text/boolean', jsonAskResult(results), [0]
+            return ('application/sparql-results+xml', xmlAskResult(results),
+                    [0])
+
+        if wantJson:
+            contentType = 'application/sparql-results+json'
+        else:
+            contentType = 'application/sparql-results+xml'
+
+        if self.streamChunkRows:
+            rowCount = [0]
+            def countRows(rows):
+                for row in rows:
+                    rowCount[0] += 1
+                    yield row
+            if wantJson:
+                chunks = jsonResultsChunks(countRows(results),
+                                           selectedVariables(query),
+                                           self.streamChunkRows)
+            else:
+                chunks = xmlResultsChunks(countRows(results),
+                                          self.streamChunkRows)
+            return contentType, chunks, rowCount
+                
+        results = list(results)
+        log.debug("got %s rows", len(results))
+        if wantJson:
+            body = jsonResults(results, selectedVariables(query))
+        else:
+            # this one is failing, not sure why
+            #ret = self.graph.queryd(query, format='xml')
+            body = fastXmlResults(results)
+        return contentType, body, [len(results)]
+
+    def _cacheResponse(self, cacheKey, generation, response):
+        """store this (contentType, body, rowCount) from _evaluate, if
+        the graph didn't change while it ran. Streamed bodies are
+        collected as they go out. Returns the response to send."""
+        contentType, body, rowCount = response
+        def store(body):
+            if (len(body) <= self.maxCachedBodyBytes and
+                self.graph.generation == generation):
+                self.responseCache.set(
+                    cacheKey, (generation, contentType, body, rowCount[0]))
+        if isinstance(body, str):
+            store(body)
+            return response
+        def collect(chunks):
+            kept, size = [], 0
+            for chunk in chunks:
+                if kept is not None:
+                    size += len(chunk)
+                    if size > self.maxCachedBodyBytes:
+                        kept = None
+                    else:
+                        kept.append(chunk)
+                yield chunk
+            if kept is not None:
+                store(''.join(kept))
+        return contentType, collect(body), rowCount
+
+    def _respond(self, request, query, t1, response):
+        """send the (contentType, body, rowCount) from _evaluate.
+        Returns the body str, or for a streamed body, the deferred
+        from _streamResponse"""
+        contentType, body, rowCount = response
+        request.setHeader('Content-Type', contentType)
+        if isinstance(body, str):
+            self._ran(request, query, t1, rowCount[0])
+            return body
+        return self._streamResponse(
+            request, body,
+            lambda: self._ran(request, query, t1, rowCount[0]))
 
+    def _queryFailed(self, query, tb):
+        self.stats.lastErrorQuery = query
+        self.stats.lastError = tb
+        log.debug("query error: %s", self.stats.lastError)
+
+    def _ran(self, request, query, t1, count):
         bindings = (request.getHeader('x-bindings') or "").split()
         queryKey = request.getHeader('x-uninterpolated-query-checksum') or query
         self.stats.ran(request.getHeader('x-source-line'),
@@ -77,16 +286,91 @@ class SPARQLResource(Resource):
                        time.time() - t1,
                        count)
 
-        if isCount:
-            return xmlCountResults(count)
+    def _finishLater(self, request, d):
+        """d will fire with the str to send (or NOT_DONE_YET if
+        something else is handling the response). Returns
+        NOT_DONE_YET for render_*"""
+        @d.addCallback
+        def write(body):
+            if body is not NOT_DONE_YET:
+                request.write(body)
+                request.finish()
+        @d.addErrback
+        def failed(err):
+            log.error(err.getTraceback())
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.write("<html>error: %s</html>" % err.getErrorMessage())
+            request.finish()
+        return NOT_DONE_YET
 
-        if request.getHeader('accept') == 'application/sparql-results+json':
-            raise NotImplementedError
-        else:
-            # this one is failing, not sure why
-            #ret = self.graph.queryd(query, format='xml')
-            ret = xmlResults(results)
-        return ret
+    def _streamResponse(self, request, chunks, done):
+        """write each string from chunks to the request, letting the
+        reactor run between them. Calls done() after the last one.
+
+        With a thread pool, each chunk is pulled from chunks in the
+        pool, since making it may evaluate more of the query.
+
+        Returns a deferred that fires with NOT_DONE_YET when the
+        stream is over, however it ended, and no chunk is still being
+        made in the pool."""
+        pulling = [] # the pool call for the latest chunk
+        def writeChunks():
+            if self.threadPool is None:
+                for chunk in chunks:
+                    request.write(chunk)
+                    yield None
+                return
+            while True:
+                pulled = []
+                got = threads.deferToThreadPool(reactor, self.threadPool,
+                                                next, chunks, None)
+                # (so the task never sees a failure after it's
+                # stopped; we raise it here instead)
+                got.addBoth(pulled.append)
+                pulling[:] = [got]
+                yield got
+                chunk = pulled[0]
+                if chunk is None:
+                    return
+                if isinstance(chunk, Failure):
+                    chunk.raiseException()
+                request.write(chunk)
+        task = cooperate(writeChunks())
+
+        # client went away; stop serializing for it
+        request.notifyFinish().addErrback(lambda err: task.stop())
+
+        def finished(_):
+            request.finish()
+            done()
+        def failed(err):
+            if err.check(TaskStopped):
+                return
+            # too late to send an error status. The client will see
+            # a truncated document.
+            log.error("error while streaming results: %s",
+                      err.getTraceback())
+            self.stats.lastError = err.getTraceback()
+            request.finish()
+        d = task.whenDone()
+        d.addCallbacks(finished, failed)
+        @d.addCallback
+        def pullFinished(_):
+            # a stopped task may still be waiting on the pool
+            if pulling and not pulling[0].called:
+                return pulling[0].addCallback(lambda _: NOT_DONE_YET)
+            return NOT_DONE_YET
+        return d
+
+    def _runWrite(self, request, func, *args):
+        """func(*args) changes the graph and returns the response
+        text. With a thread pool, it waits for the running queries
+        and then runs alone in the pool."""
+        if self.threadPool is None:
+            return func(*args)
+        d = self.lock.runWrite(threads.deferToThreadPool, reactor,
+                               self.threadPool, func, *args)
+        return self._finishLater(request, d)
 
     def getSave(self, request):
         """GET /save?context=http://example.org saves a context to a
@@ -108,29 +392,116 @@ class SPARQLResource(Resource):
 
         """
         if request.path == '/add':
-            ctx = URIRef(request.args['context'][0])
-            stmts = statementsFromNt(request.content)
-            log.debug("add %s stmts to context %s", len(stmts), ctx)
-            self.graph.add(*stmts, **dict(context=ctx))
-            return "added to %s" % str(ctx)
+            return self._runWrite(request, self.postAdd, request)
 
         if request.path == '/remove':
-            stmts = statementsFromNt(request.content)
-            arg = request.args.get('context')
-            if arg is not None:
-                arg = URIRef(arg[0])
-            log.debug("remove %s stmts from context=%s", len(stmts), arg)
-            self.graph.remove(*stmts, **dict(context=arg))
-            return "removed from context %s" % str(arg)
+            return self._runWrite(request, self.postRemove, request)
 
         if request.path == '/save':
-            return self.getSave(request)
+            return self._runWrite(request, self.getSave, request)
 
         request.setResponseCode(http.BAD_REQUEST)
         return "<html>unknown post path %r</html>" % request.postpath
 
-def statementsFromNt(nt):
-    g = Graph()
-    g.parse(nt, format='nt')
-    stmts = list(g)
-    return stmts
+    def postAdd(self, request):
+        ctx = URIRef(request.args['context'][0])
+        n = self._ingest(request,
+                         lambda batch: self.graph.add(batch, context=ctx))
+        log.debug("added %s stmts to context %s", n, ctx)
+        return "added to %s" % str(ctx)
+
+    def postRemove(self, request):
+        arg = request.args.get('context')
+        if arg is not None:
+            arg = URIRef(arg[0])
+        n = self._ingest(request,
+                         lambda batch: self.graph.remove(batch, context=arg))
+        log.debug("removed %s stmts from context=%s", n, arg)
+        return "removed from context %s" % str(arg)
+
+    def _ingest(self, request, write):
+        """pass the posted N-Triples to write(list of stmts), in
+        batches of ingestBatchSize. Returns the statement count"""
+        self.stats.ingestStarted(request.path)
+        def onBatch(batch):
+            write(batch)
+            self.stats.ingested(len(batch))
+        try:
+            return readNTriples(request.content, onBatch, self.ingestBatchSize)
+        finally:
+            self.stats.ingestFinished()
+
+class ResponseCache(LRUCache):
+    """(generation, contentType, body, rowCount) entries, which are
+    good until the graph's generation changes"""
+    def __init__(self, graph, maxSize):
+        LRUCache.__init__(self, maxSize)
+        self.graph = graph
+
+    def _stillValid(self, key, entry):
+        return entry[0] == self.graph.generation
+
+class ReadWriteLock(object):
+    """deferred-based lock for any number of readers at once, or one
+    writer alone. A waiting writer holds off new readers so it
+    doesn't starve. Use it from the reactor thread only."""
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.waiting = [] # (isWrite, deferred)
+
+    def runRead(self, func, *args, **kw):
+        """deferred to the result of func, which runs (and may return
+        a deferred) while we hold a read lock"""
+        return self._run(False, func, args, kw)
+
+    def runWrite(self, func, *args, **kw):
+        return self._run(True, func, args, kw)
+
+    def _run(self, isWrite, func, args, kw):
+        d = defer.Deferred()
+        d.addCallback(lambda _: func(*args, **kw))
+        @d.addBoth
+        def release(result):
+            if isWrite:
+                self.writing = False
+            else:
+                self.readers -= 1
+            self._wake()
+            return result
+        self.waiting.append((isWrite, d))
+        self._wake()
+        return d
+
+    def _wake(self):
+        while self.waiting and not self.writing:
+            isWrite, d = self.waiting[0]
+            if isWrite:
+                if self.readers:
+                    return
+                self.writing = True
+            else:
+                self.readers += 1
+            self.waiting.pop(0)
+            d.callback(None)
+
+def acceptsJson(request):
+    """does this request's Accept header list the json results type?"""
+    accept = request.getHeader('accept') or ''
+    return 'application/sparql-results+json' in [
+        t.split(';')[0].strip() for t in accept.split(',')]
+
+def etagMatches(request, etag):
+    """does this request's If-None-Match list this etag?"""
+    header = request.getHeader('if-none-match')
+    if not header:
+        return False
+    return etag in [t.strip() for t in header.split(',')] or header == '*'
+
+def selectedVariables(query):
+    """the variable names (without '?') for the results head, or []
+    if the query is too odd for sparqlSelection"""
+    try:
+        return [v.lstrip('?') for v in sparqlSelection(query)]
+    except (AssertionError, IndexError):
+        return []
@@ -11,6 +11,7 @@ import restkit
 from sparqlhttp.sparqlxml import parseSparqlResults
 from sparqlhttp.dictquery import Graph2
 from sparqlhttp.remotegraph import interpolateSparql
+from sparqlhttp.ntriples import encodeNTriples
 
 
 def allegroCall(call, *args, **kwargs):
@@ -67,6 +68,10 @@ class RemoteSparql(Graph2):
                             ).body_string()
         return parseSparqlResults(xml.encode('utf-8'))
 
+    def countQuery(self, query, initBindings={}):
+        # (Graph2's version runs the query on a local rdflib graph)
+        return len(self.queryd(query, initBindings))
+
     def safeParse(self, source, publicID=None, format="xml"):
 
         graph = Graph()
@@ -101,17 +106,10 @@ class RemoteSparql(Graph2):
         except KeyError:
             raise TypeError("'context' named argument is required")
 
-        graph = Graph()
-        for p, f in self.initNs.items():
-            graph.bind(p, f)
-        for s in triples:
-            graph.add(s)
-
         allegroCall(self.root.post, '/%s/statements' % self.repoName,
                     context=context.n3(),
-                    payload=graph.serialize(format='xml'),
-                    headers={'Content-Type' : 'application/rdf+xml'})
-        triples
+                    payload=encodeNTriples(triples),
+                    headers={'Content-Type' : 'text/plain'})
 
         self._graphModified()
 
@@ -1,8 +1,71 @@
-import jsonlib
-from rdflib import Literal, URIRef
+import re, os, json
+from json.encoder import encode_basestring_ascii
+from rdflib import Literal, URIRef, BNode
+from sparqlhttp.rows import RowMaker
+from sparqlhttp.cache import TermInterner
 
-def parseJsonResults(jsonResults):
-    """returns the same as parseSparqlResults. Takes json string like this:
+def _findJsonBackends():
+    """list of (name, loads, takesBytes) for the json decoders that
+    are installed, fastest first. takesBytes means loads can have the
+    utf-8 body as it is, instead of a unicode copy of it"""
+    found = []
+    try:
+        import ujson
+        found.append(('ujson', ujson.loads, True))
+    except ImportError:
+        pass
+    try:
+        import simplejson, simplejson.scanner
+        if simplejson.scanner.c_make_scanner is not None:
+            found.append(('simplejson', simplejson.loads, True))
+    except ImportError:
+        pass
+    from json import scanner
+    if scanner.c_make_scanner is not None:
+        found.append(('json', json.loads, True))
+    try:
+        import jsonlib
+        # jsonlib guesses the encoding of a str, which is slow
+        found.append(('jsonlib', jsonlib.loads, False))
+    except ImportError:
+        pass
+    if scanner.c_make_scanner is None:
+        found.append(('json', json.loads, True)) # pure python, slowest
+    return found
+
+jsonBackends = _findJsonBackends()
+_jsonBackend = jsonBackends[0]
+
+def setJsonBackend(name):
+    """use this decoder (one of the names in jsonBackends) instead
+    of the fastest one. You can also set SPARQLHTTP_JSON in the
+    environment before importing this module."""
+    global _jsonBackend
+    for backend in jsonBackends:
+        if backend[0] == name:
+            _jsonBackend = backend
+            return
+    raise ValueError("json backend %r is not available (have %s)" % (
+        name, ', '.join(b[0] for b in jsonBackends)))
+
+def jsonBackend():
+    """name of the decoder in use"""
+    return _jsonBackend[0]
+
+if os.environ.get('SPARQLHTTP_JSON'):
+    setJsonBackend(os.environ['SPARQLHTTP_JSON'])
+
+def loadJson(text):
+    """parse json text (utf-8 str or unicode) with the chosen
+    decoder"""
+    name, loads, takesBytes = _jsonBackend
+    if not takesBytes and isinstance(text, str):
+        text = text.decode('utf8')
+    return loads(text)
+
+def parseJsonResults(jsonResults, compact=False, variables=None, terms=None):
+    """returns the same as parseSparqlResults, including the compact,
+    variables and terms options. Takes json string like this:
 
     { 'head': { 'link': [], 'vars': ['p', 'o'] },
       'results': { 'distinct': false, 'ordered': true, 'bindings': [
@@ -17,41 +80,263 @@ def parseJsonResults(jsonResults):
       ...
     """
 
-    # for speed, don't let jsonlib poke at the string to figure out the encoding
-    jsonResults = jsonResults.decode('utf8')
-    
     if jsonResults in ['true', 'false']:
         # this would have been made explicit in the Content-type
         # header, but I don't have that handy.
         return jsonResults == 'true'
+    doc = loadJson(jsonResults)
+    if terms is None:
+        terms = TermInterner()
+    maker = None
+    if compact:
+        if variables is None:
+            variables = doc.get('head', {}).get('vars', ())
+        maker = RowMaker(variables)
     ret = []
-    for row in jsonlib.loads(jsonResults)['results']['bindings']:
+    for row in doc['results']['bindings']:
         outRow = {}
         for k, v in row.items():
-            outRow[k] = parseJsonTerm(v)
+            outRow[k] = parseJsonTerm(v, terms)
+        if maker is not None:
+            outRow = maker.row(outRow)
         ret.append(outRow)
     return ret
 
 
+class JsonResultsParser(object):
+    """parseJsonResults for a document that arrives in pieces. Each
+    feed() returns the rows that were completed by that piece:
+
+        parser = JsonResultsParser()
+        for data in pieces:
+            for row in parser.feed(data):
+                ...
+        parser.close()
+
+    Only the current row's text is held in memory, never the whole
+    document. ASK results aren't handled. compact, variables and
+    terms are the same as for parseSparqlResults.
+    """
+    _whitespace = re.compile(r'\s*')
+
+    def __init__(self, compact=False, variables=None, terms=None):
+        self._maker = None
+        if compact:
+            self._maker = RowMaker(variables or ())
+        self._headVars = variables is None
+        if terms is None:
+            terms = TermInterner()
+        self._terms = terms
+        self._buf = ''
+        self._pos = 0
+        # start -> top (keys of the document) -> results (keys of
+        # 'results') -> rows (in the 'bindings' array) -> done
+        self._state = 'start'
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return self._parse()
+
+    def close(self):
+        """raises ValueError if the document was incomplete"""
+        if self._state != 'done':
+            raise ValueError("sparql json results ended early (at %r)" %
+                             self._buf[self._pos:self._pos + 100])
+
+    def _parse(self):
+        rows = []
+        buf, decode = self._buf, self._decoder.raw_decode
+        while self._state != 'done':
+            pos = self._whitespace.match(buf, self._pos).end()
+            if pos >= len(buf):
+                break
+            c = buf[pos]
+            if self._state == 'start':
+                if c != '{':
+                    raise ValueError("not a sparql json results document")
+                self._state, self._pos = 'top', pos + 1
+            elif c == ',':
+                self._pos = pos + 1
+            elif self._state == 'rows':
+                if c == ']':
+                    self._state = 'done'
+                    break
+                try:
+                    row, self._pos = decode(buf, pos)
+                except ValueError:
+                    break # (the rest of the row hasn't come yet)
+                outRow = {}
+                for k, v in row.items():
+                    outRow[k] = parseJsonTerm(v, self._terms)
+                if self._maker is not None:
+                    outRow = self._maker.row(outRow)
+                rows.append(outRow)
+            else:
+                if c == '}':
+                    raise ValueError("sparql json results had no bindings")
+                try:
+                    key, end = decode(buf, pos)
+                except ValueError:
+                    break
+                end = self._whitespace.match(buf, end).end()
+                valueStart = self._whitespace.match(buf, end + 1).end()
+                if valueStart >= len(buf):
+                    break
+                if buf[end] != ':':
+                    raise ValueError("expected ':' after %r" % key)
+                opener = buf[valueStart]
+                if self._state == 'top' and key == 'results':
+                    if opener != '{':
+                        raise ValueError("'results' is not an object")
+                    self._state, self._pos = 'results', valueStart + 1
+                elif self._state == 'results' and key == 'bindings':
+                    if opener != '[':
+                        raise ValueError("'bindings' is not an array")
+                    self._state, self._pos = 'rows', valueStart + 1
+                else:
+                    # skip this value (like 'head')
+                    try:
+                        value, end = decode(buf, valueStart)
+                    except ValueError:
+                        break
+                    if end >= len(buf):
+                        break # a number might have more digits coming
+                    self._pos = end
+                    if (self._state == 'top' and key == 'head' and
+                        self._maker is not None and self._headVars):
+                        self._maker = RowMaker(value.get('vars', ()))
+        return rows
+
+def iterJsonResults(pieces, compact=False, variables=None, terms=None):
+    """the rows of a json results document that comes in pieces
+    (like a file read in blocks), as they're completed"""
+    parser = JsonResultsParser(compact, variables, terms)
+    for data in pieces:
+        for row in parser.feed(data):
+            yield row
+    parser.close()
+
 def jsonRowCount(jsonResults):
-    """given a json string like parseJsonTerm takes, just count the rows"""
-    return len(jsonlib.loads(jsonResults)['results']['bindings'])
+    """given a json string like parseJsonTerm takes, just count the
+    rows. A jsonCountResults document gives its count instead."""
+    doc = loadJson(jsonResults)
+    if 'ext:count' in doc:
+        return int(doc['ext:count'])
+    return len(doc['results']['bindings'])
+
+def jsonCountResults(count):
+    """a made-up format for count query results, like
+    sparqlxml.xmlCountResults. It's an empty result set with an extra
+    'ext:count' key."""
+    return '{"head": {"vars": []}, "results": {"bindings": []}, "ext:count": %d}' % count
     
-def parseJsonTerm(d):
+def parseJsonTerm(d, terms=None):
     """rdflib object (Literal, URIRef, BNode) for the given json-format dict.
     
     input is like:
       { 'type': 'uri', 'value': 'http://famegame.com/2006/01/username' }
       { 'type': 'literal', 'value': 'drewp' }
+
+    terms is an optional sparqlhttp.cache.TermInterner to get shared
+    URIRefs and Literals from.
     """
     # this implementation is purely a guess. i haven't looked up the spec yet.
     
     t = d['type']
     if t == 'uri':
+        if terms is not None:
+            return terms.uri(d['value'])
         return URIRef(d['value'])
-    elif t == 'literal':
-        return Literal(d['value'])
-    elif t == 'typed-literal':
-        return Literal(d['value'], datatype=URIRef(d['datatype']))
+    elif t == 'literal' or t == 'typed-literal':
+        if terms is not None:
+            return terms.literal(d['value'], d.get('datatype'),
+                                 d.get('xml:lang'))
+        datatype = d.get('datatype')
+        if datatype is not None:
+            datatype = URIRef(datatype)
+        return Literal(d['value'], lang=d.get('xml:lang'), datatype=datatype)
+    elif t == 'bnode':
+        return BNode(d['value'])
     else:
         raise NotImplementedError("json term type %r" % t)
+
+
+def jsonResults(resultRows, variables=None):
+    """json text for a list of sparql result dicts; the inverse of
+    parseJsonResults. variables is the list of selected variable
+    names for the head (without '?')."""
+    return ''.join(jsonResultsChunks(resultRows, variables))
+
+def jsonAskResult(answer):
+    """the text/boolean form of an ASK result"""
+    return answer and 'true' or 'false'
+
+def jsonResultsChunks(resultRows, variables=None, chunkRows=1000):
+    """the jsonResults document in pieces of about chunkRows rows
+    each, pulling rows from resultRows (any iterable) only as the
+    pieces are needed"""
+    yield '{"head": {"vars": [%s]}, "results": {"bindings": [\n' % (
+        ', '.join(encode_basestring_ascii(v) for v in (variables or [])))
+
+    names = {} # var name : '"name": '
+    uris = {} # URIRef : its whole json term
+    literalTail = {} # (datatype, lang) : end of the json term
+
+    out = []
+    n = 0
+    sep = ''
+    for row in resultRows:
+        out.append(sep)
+        sep = ',\n'
+        out.append('{')
+        comma = ''
+        for k, v in row.items():
+            if v is None:
+                continue
+            out.append(comma)
+            comma = ', '
+            try:
+                out.append(names[k])
+            except KeyError:
+                out.append(names.setdefault(
+                    k, encode_basestring_ascii(k) + ': '))
+            if isinstance(v, URIRef):
+                try:
+                    out.append(uris[v])
+                except KeyError:
+                    out.append(uris.setdefault(
+                        v, '{"type": "uri", "value": %s}' %
+                        encode_basestring_ascii(v)))
+            elif isinstance(v, Literal):
+                out.append('{"value": ')
+                out.append(encode_basestring_ascii(v))
+                key = v.datatype, v.language
+                try:
+                    out.append(literalTail[key])
+                except KeyError:
+                    out.append(literalTail.setdefault(key, _literalTail(*key)))
+            elif isinstance(v, BNode):
+                out.append('{"type": "bnode", "value": %s}' %
+                           encode_basestring_ascii(v))
+            else:
+                raise TypeError("unknown term type %r" % v)
+        out.append('}')
+        n += 1
+        if n >= chunkRows:
+            yield ''.join(out)
+            out = []
+            n = 0
+    if out:
+        yield ''.join(out)
+    yield '\n]}}'
+
+def _literalTail(datatype, lang):
+    if datatype is not None:
+        return ', "type": "typed-literal", "datatype": %s}' % (
+            encode_basestring_ascii(datatype))
+    if lang:
+        return ', "type": "literal", "xml:lang": %s}' % (
+            encode_basestring_ascii(lang))
+    return ', "type": "literal"}'
@@ -1,6 +1,10 @@
 from nevow import flat, tags as T, stan, json
 from nevow.stan import Tag
 from rdflib import URIRef, Literal, BNode
+from StringIO import StringIO
+import itertools
+from sparqlhttp.rows import RowMaker
+from sparqlhttp.cache import TermInterner
 try:
     from xml.etree import cElementTree as ElementTree
 except ImportError:
@@ -9,13 +13,17 @@ except ImportError:
 see http://www.w3.org/TR/rdf-sparql-XMLres/
 
 
-Todo:
-- literal language support (currently ignored)
+xmlResults builds the document with nevow stan; fastXmlResults and
+xmlResultsChunks write the same document directly as text and are
+much faster (see benchmark.py). Only the fast ones write xml:lang.
 """
 
 RESULTS_NS = "http://www.w3.org/2005/sparql-results#"
 EXTENDED_NS = "http://projects.bigasterisk.com/2006/01/sparqlExtended/"
 RESULTS_NS_ET = '{%s}' % RESULTS_NS
+XML_LANG_ET = '{http://www.w3.org/XML/1998/namespace}lang'
+EXT_COUNT_ET = '{%s}count' % EXTENDED_NS
+BOOLEAN_ET = RESULTS_NS_ET + 'boolean'
 
 def term(t):
     """stan xml node for the given rdflib term"""
@@ -32,23 +40,33 @@ def term(t):
         raise TypeError("unknown term type %r" % t)
 #        return Tag("literal")['<none>']
 
-def parseTerm(element):
+def parseTerm(element, terms=None):
     """rdflib object (Literal, URIRef, BNode) for the given
-    elementtree element"""
-    tag, text = element.tag, element.text
+    elementtree element. terms is an optional
+    sparqlhttp.cache.TermInterner to get shared URIRefs and Literals
+    from."""
+    return _term(element.tag, element.text, element, terms)
+
+def _term(tag, text, attrib, terms):
+    """parseTerm, from the parts of the element"""
     if tag == RESULTS_NS_ET + 'literal':
         if text is None:
             text = ''
-        ret = Literal(text)
-        if element.get('datatype', None):
-            ret.datatype = URIRef(element.get('datatype'))
+        if terms is not None:
+            return terms.literal(text, attrib.get('datatype') or None,
+                                 attrib.get(XML_LANG_ET, None))
+        ret = Literal(text, lang=attrib.get(XML_LANG_ET, None))
+        if attrib.get('datatype', None):
+            ret.datatype = URIRef(attrib.get('datatype'))
         return ret
     elif tag == RESULTS_NS_ET + 'uri':
+        if terms is not None:
+            return terms.uri(text)
         return URIRef(text)
     elif tag == RESULTS_NS_ET + 'bnode':
         return BNode(text)
     else:
-        raise TypeError("unknown binding type %r" % element)
+        raise TypeError("unknown binding type %r" % tag)
 
 def xmlResults(resultRows):
     """xml text for a list of sparql results. These rows are a list of
@@ -88,6 +106,88 @@ def xmlResults(resultRows):
           ]
         )
 
+def fastXmlResults(resultRows):
+    """same as xmlResults, but written straight to text instead of
+    through stan"""
+    return ''.join(xmlResultsChunks(resultRows))
+
+def xmlResultsChunks(resultRows, chunkRows=1000):
+    """the fastXmlResults document in pieces of about chunkRows rows
+    each (utf-8 strs), pulling rows from resultRows (which can be any
+    iterable) only as the pieces are needed."""
+    yield ('<?xml version="1.0"?>\n<sparql xmlns="%s">'
+           '<head><variable name="notimplemented"></variable></head>'
+           '<results ordered="notimplemented" distinct="notimplemented">'
+           % RESULTS_NS)
+
+    # escaped text for the terms that tend to repeat
+    bindingOpen = {} # var name : '<binding name="...">'
+    uris = {} # URIRef : '<uri>...</uri>'
+    literalOpen = {} # (datatype, lang) : '<literal ...>'
+
+    out = []
+    n = 0
+    for row in resultRows:
+        out.append(u'<result>')
+        for k, v in row.items():
+            if v is None:
+                continue
+            try:
+                out.append(bindingOpen[k])
+            except KeyError:
+                out.append(bindingOpen.setdefault(
+                    k, u'<binding name=%s>' % _attr(k)))
+            if isinstance(v, URIRef):
+                try:
+                    out.append(uris[v])
+                except KeyError:
+                    out.append(uris.setdefault(
+                        v, u'<uri>%s</uri>' % _text(v)))
+            elif isinstance(v, Literal):
+                key = v.datatype, v.language
+                try:
+                    out.append(literalOpen[key])
+                except KeyError:
+                    out.append(literalOpen.setdefault(key, _literalOpen(*key)))
+                out.append(_text(v))
+                out.append(u'</literal>')
+            elif isinstance(v, BNode):
+                out.append(u'<bnode>%s</bnode>' % _text(v))
+            else:
+                raise TypeError("unknown term type %r" % v)
+            out.append(u'</binding>')
+        out.append(u'</result>')
+        n += 1
+        if n >= chunkRows:
+            yield u''.join(out).encode('utf-8')
+            out = []
+            n = 0
+    if out:
+        yield u''.join(out).encode('utf-8')
+    yield '</results></sparql>'
+
+def _text(s):
+    if '&' in s or '<' in s or '>' in s:
+        s = s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return s
+
+def _attr(s):
+    return u'"%s"' % _text(s).replace('"', '&quot;')
+
+def _literalOpen(datatype, lang):
+    ret = u'<literal'
+    if datatype is not None:
+        ret += u' datatype=%s' % _attr(datatype)
+    if lang:
+        ret += u' xml:lang=%s' % _attr(lang)
+    return ret + u'>'
+
+def xmlAskResult(answer):
+    """the sparql results document for an ASK result"""
+    return ('<?xml version="1.0"?>\n<sparql xmlns="%s"><head></head>'
+            '<boolean>%s</boolean></sparql>' %
+            (RESULTS_NS, answer and 'true' or 'false'))
+
 def xmlCountResults(count):
     """a made-up format for count query results"""
     return '<?xml version="1.0"?>\n' + flat.flatten(
@@ -101,19 +201,28 @@ def parseCountTree(tree):
     elementtree, or raise ValueError if it's not a count result"""
     results = tree.find(RESULTS_NS_ET + 'results')
     children = list(results)
-    if len(children) == 1 and children[0].tag == '{%s}count' % EXTENDED_NS:
+    if len(children) == 1 and children[0].tag == EXT_COUNT_ET:
         return int(children[0].text)
     raise ValueError("sparql results are not in the extended count format")
 
-def parseSparqlResults(xmlResults):
+def parseSparqlResults(xmlResults, compact=False, variables=None, terms=None):
     """
     list of rows of {var1 : value1, var2 : value2, ...} dicts for the
-    given sparql result xml
+    given sparql result xml, or True/False for an ASK result
 
     this parser is -really- loose.
 
     pass the ElementTree instead of the string if you want
 
+    With compact=True, the rows are sparqlhttp.rows.Row objects
+    instead of dicts, with a key for every one of variables (the
+    selected names, without '?'). Unbound ones are None, so you don't
+    need _addOptionalVars.
+
+    terms is a sparqlhttp.cache.TermInterner to share terms with
+    other results. Without one, repeated terms are only shared
+    within this result.
+
     This is the inverse of xmlResults."""
     if isinstance(xmlResults, basestring):
         if isinstance(xmlResults, unicode):
@@ -128,16 +237,159 @@ def parseSparqlResults(xmlResults):
     else:
         tree = xmlResults
 
+    boolean = tree.find(BOOLEAN_ET)
+    if boolean is not None:
+        return _answer(boolean)
+
     results = tree.find(RESULTS_NS_ET + 'results')
     
+    if terms is None:
+        terms = TermInterner()
+    maker = compact and RowMaker(variables or ())
     ret = []
     for result in results:
         r = {}
         for binding in result:
-            r[binding.get('name')] = parseTerm(binding[0])
+            r[binding.get('name')] = parseTerm(binding[0], terms)
+        if compact:
+            r = maker.row(r)
         ret.append(r)
     return ret
 
+def iterParseSparqlResults(source, compact=False, variables=None,
+                           terms=None):
+    """the rows of parseSparqlResults, yielded one at a time as
+    they're read. source is the document text or a file object. Rows
+    that have been yielded are dropped from the tree, so memory use
+    stays flat however big the document is.
+
+    For an ASK result, this returns True/False instead of an
+    iterator, so it reads up to the first row before returning."""
+    elements = _resultElements(source)
+    first = next(elements, None)
+    if first is not None and first.tag == BOOLEAN_ET:
+        return _answer(first)
+    return _iterRows(first, elements, compact, variables, terms)
+
+def _iterRows(first, elements, compact, variables, terms):
+    """rows for the first element (if any) and the rest of them"""
+    if first is None:
+        return
+    if terms is None:
+        terms = TermInterner()
+    maker = compact and RowMaker(variables or ())
+    for element in itertools.chain([first], elements):
+        if element.tag == EXT_COUNT_ET:
+            raise ValueError("sparql results are a count, not rows")
+        row = {}
+        for binding in element:
+            row[binding.get('name')] = parseTerm(binding[0], terms)
+        if compact:
+            row = maker.row(row)
+        yield row
+
+def countSparqlResults(source):
+    """number of rows in the document (text or a file object),
+    without making any terms. An extended count result (see
+    xmlCountResults) gives its count."""
+    n = 0
+    for element in _resultElements(source):
+        if element.tag == EXT_COUNT_ET:
+            return int(element.text)
+        if element.tag == BOOLEAN_ET:
+            raise ValueError("sparql results are an ASK answer, not rows")
+        n += 1
+    return n
+
+def _answer(boolean):
+    """True/False from the <boolean> element"""
+    return (boolean.text or '').strip() == 'true'
+
+def _resultElements(source):
+    """each <result> (and ext:count or <boolean>) element, as soon
+    as it's complete. The tree forgets each one when you ask for the
+    next."""
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    if isinstance(source, str):
+        source = StringIO(source)
+    results = None
+    for event, element in ElementTree.iterparse(source,
+                                                 events=('start', 'end')):
+        if event == 'start':
+            if element.tag == RESULTS_NS_ET + 'results':
+                results = element
+        elif element.tag in (RESULTS_NS_ET + 'result', EXT_COUNT_ET,
+                             BOOLEAN_ET):
+            yield element
+            if results is not None:
+                # (the parser may have already started the next
+                # result, but it keeps its own reference to that one)
+                results.clear()
+
+class XmlResultsParser(object):
+    """parseSparqlResults for a document that arrives in pieces, like
+    sparqljson.JsonResultsParser. Each feed() returns the rows that
+    were completed by that piece, and close() raises if the document
+    was incomplete. No tree is built, so only the current row is held
+    in memory."""
+    def __init__(self, compact=False, variables=None, terms=None):
+        self._target = _ResultsTarget(compact and RowMaker(variables or ()),
+                                      terms)
+        self._parser = ElementTree.XMLParser(target=self._target)
+
+    def feed(self, data):
+        self._parser.feed(data)
+        rows, self._target.rows = self._target.rows, []
+        return rows
+
+    def close(self):
+        self._parser.close()
+
+class _ResultsTarget(object):
+    """XMLParser target that makes rows from the <result> elements"""
+    def __init__(self, maker, terms):
+        self.maker = maker
+        if terms is None:
+            terms = TermInterner()
+        self.terms = terms
+        self.rows = []
+        self.row = None
+        self.name = None
+        self.text = None # list of pieces, inside a term element
+        self.attrib = None
+
+    def start(self, tag, attrib):
+        if tag == RESULTS_NS_ET + 'result':
+            self.row = {}
+        elif tag == RESULTS_NS_ET + 'binding':
+            self.name = attrib.get('name')
+        elif self.name is not None:
+            self.text, self.attrib = [], attrib
+        elif tag == EXT_COUNT_ET:
+            raise ValueError("sparql results are a count, not rows")
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if tag == RESULTS_NS_ET + 'result':
+            row = self.row
+            if self.maker:
+                row = self.maker.row(row)
+            self.rows.append(row)
+            self.row = None
+        elif tag == RESULTS_NS_ET + 'binding':
+            self.name = None
+        elif self.text is not None:
+            self.row[self.name] = _term(tag, ''.join(self.text) or None,
+                                        self.attrib, self.terms)
+            self.text = None
+
+    def close(self):
+        pass
+
 def test():
     result = [dict(x=URIRef("http://some/uri"),
                    y=Literal("lit1"),
@@ -151,6 +403,31 @@ def test():
     print xmlResults(result)
     
     assert parseSparqlResults(xmlResults(result)) == result
+    assert parseSparqlResults(fastXmlResults(result)) == result
+
+    tricky = [dict(x=URIRef("http://some/uri?a=1&b=<2>"),
+                   y=Literal(u'"quoted" & caf\xe9 <b>', lang="fr"),
+                   z=BNode("b1"))]
+    assert parseSparqlResults(fastXmlResults(tricky)) == tricky
+
+    assert list(iterParseSparqlResults(fastXmlResults(result))) == result
+    doc = fastXmlResults(result)
+    for size in [1, 7, len(doc)]:
+        parser = XmlResultsParser()
+        rows = []
+        for i in range(0, len(doc), size):
+            rows.extend(parser.feed(doc[i:i + size]))
+        parser.close()
+        assert rows == result
+    assert countSparqlResults(fastXmlResults(result)) == 2
+    for answer in [True, False]:
+        assert parseSparqlResults(xmlAskResult(answer)) is answer
+        assert iterParseSparqlResults(xmlAskResult(answer)) is answer
+    assert list(iterParseSparqlResults(fastXmlResults([]))) == []
+    assert countSparqlResults(xmlCountResults(5)) == 5
+    compact = parseSparqlResults(fastXmlResults(result), compact=True,
+                                 variables=['x', 'y', 'z'])
+    assert compact == [dict(result[0]), dict(result[1], z=None)]
     
 if __name__ == '__main__':
     test()
@@ -9,6 +9,9 @@ from zope.interface import implements
 class Stats(object):
     """gather and report stats about the queries that are made, their
     errors, runtimes, etc"""
+
+    responseCache = None # a cache with a stats() method, if any
+
     def __init__(self):
         self.powerOnTime = time.time()
         self.queries = 0
@@ -16,6 +19,12 @@ class Stats(object):
         self.lastError = ""
         self.lastQuery = ''
 
+        # statements written by /add and /remove
+        self.added = 0
+        self.removed = 0
+        self.ingestBatches = 0
+        self.ingestRunning = None # [path, stmts so far, start time]
+
         self.counts = {} # (queryKey, bound) : (query, n, total elapsed, total rows)
         self.sources = {} # query : [sources]
     
@@ -33,6 +42,21 @@ class Stats(object):
         elif source not in self.sources[key]:
             self.sources[key].append(source)
 
+    def ingestStarted(self, path):
+        self.ingestRunning = [path, 0, time.time()]
+
+    def ingested(self, n):
+        """a batch of n statements from the running ingest was written"""
+        self.ingestBatches += 1
+        self.ingestRunning[1] += n
+        if self.ingestRunning[0] == '/remove':
+            self.removed += n
+        else:
+            self.added += n
+
+    def ingestFinished(self):
+        self.ingestRunning = None
+
     def __getstate__(self):
         return self.counts, self.sources
     def __setstate__(self, s):
@@ -98,6 +122,8 @@ class Stats(object):
                                       T.div[T.span["Up for "],
                                             "%.1f" % upHours, T.span[" hours"]],
                                       T.div[self.queries, T.span[" queries"]]],
+              self.cacheSection(),
+              self.ingestSection(),
               T.div(class_="section")[T.h2["Last error"],
                                       T.div[T.span["query: "],
                                             T.pre[self.lastErrorQuery]],
@@ -116,6 +142,34 @@ class Stats(object):
             ]))
         
 
+    def cacheSection(self):
+        if self.responseCache is None:
+            return ''
+        st = self.responseCache.stats()
+        return T.div(class_="section")[
+            T.h2["Response cache"],
+            T.div[st['hits'], T.span[" hits, "],
+                  st['misses'], T.span[" misses, "],
+                  st['evictions'], T.span[" evictions"]],
+            T.div[st['size'], T.span[" of "], st['maxSize'],
+                  T.span[" entries in use"]]]
+
+    def ingestSection(self):
+        running = ''
+        if self.ingestRunning is not None:
+            path, n, t1 = self.ingestRunning
+            secs = time.time() - t1
+            running = T.div[T.span["Now running %s: " % path], n,
+                            T.span[" stmts in "], "%.1f" % secs,
+                            T.span[" sec ("], "%.1f" % (n / max(secs, .001)),
+                            T.span[" per sec)"]]
+        return T.div(class_="section")[
+            T.h2["Writes"],
+            T.div[self.added, T.span[" stmts added, "],
+                  self.removed, T.span[" stmts removed, in "],
+                  self.ingestBatches, T.span[" batches"]],
+            running]
+
 def stripPrefixes(q):
     """remove PREFIX lines from a query"""
     new = ""
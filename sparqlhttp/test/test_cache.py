@@ -0,0 +1,138 @@
+import sys
+from twisted.trial import unittest
+sys.path.append("..")
+from rdflib import RDFS, Literal, URIRef
+from sparqlhttp.cache import LRUCache, PredicateCache, SubjectCache, Miss, TermInterner
+
+from shared import EXP
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(maxSize=2)
+
+    def testMiss(self):
+        self.assert_(self.cache.get('k') is Miss)
+        self.assertEqual(self.cache.misses, 1)
+
+    def testHit(self):
+        self.cache.set('k', [{'x' : EXP['a']}])
+        self.assertEqual(self.cache.get('k'), [{'x' : EXP['a']}])
+        self.assertEqual(self.cache.hits, 1)
+
+    def testFalseResultIsNotMiss(self):
+        self.cache.set('ask', False)
+        self.assert_(self.cache.get('ask') is False)
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assert_(self.cache.get('b') is Miss)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def testInvalidateClears(self):
+        self.cache.set('a', 1)
+        self.cache.invalidate([(EXP['s'], EXP['p'], EXP['o'])], EXP['ctx'])
+        self.assert_(self.cache.get('a') is Miss)
+        self.assertEqual(len(self.cache), 0)
+
+class PredicateCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = PredicateCache(ttl={RDFS.label : 3600,
+                                         EXP['status'] : 1})
+        self.cache._now = lambda: self.now
+
+    def testTtlFromBinding(self):
+        self.cache.set('k', [{'o' : Literal('L')}],
+                       "SELECT DISTINCT ?o WHERE { ?s ?p ?o }",
+                       {'s' : EXP['a'], 'p' : RDFS.label})
+        self.now += 3000
+        self.assertEqual(self.cache.get('k'), [{'o' : Literal('L')}])
+        self.now += 1000
+        self.assert_(self.cache.get('k') is Miss)
+
+    def testShortestTtlWins(self):
+        self.cache.set('k', [], "SELECT ?x WHERE { ?x <%s> ?y . ?x <%s> ?z }"
+                       % (RDFS.label, EXP['status']))
+        self.now += 2
+        self.assert_(self.cache.get('k') is Miss)
+
+    def testDefaultTtlZeroIsNotCached(self):
+        self.cache.set('k', [], "SELECT ?x WHERE { ?x <http://other/> ?y }")
+        self.assertEqual(len(self.cache), 0)
+
+    def testPredicateStats(self):
+        q = "SELECT ?x WHERE { ?x <%s> ?y }" % EXP['status']
+        self.cache.set('k', [], q)
+        self.cache.get('k')
+        self.cache.get('k')
+        stats = self.cache.predicateStats()[EXP['status']]
+        self.assertEqual((stats['hits'], stats['misses'], stats['ttl']),
+                         (2, 1, 1))
+
+class SubjectCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = SubjectCache()
+        q = "SELECT DISTINCT ?o WHERE { ?s ?p ?o }"
+        self.cache.set('a', [], q, {'s' : EXP['a'], 'p' : RDFS.label})
+        self.cache.set('b', [], q, {'s' : EXP['b'], 'p' : RDFS.label})
+        self.cache.set('all', [], "SELECT ?s WHERE { ?s ?p ?o }", {})
+
+    def testWriteDropsOnlyThatSubject(self):
+        self.cache.invalidate([(EXP['a'], RDFS.label, Literal('new'))],
+                              EXP['ctx'])
+        self.assert_(self.cache.get('a') is Miss)
+        self.assert_(self.cache.get('all') is Miss)
+        self.assertEqual(self.cache.get('b'), [])
+
+    def testResourceObjectCounts(self):
+        self.cache.invalidate([(EXP['c'], EXP['knows'], EXP['b'])],
+                              EXP['ctx'])
+        self.assertEqual(self.cache.get('a'), [])
+        self.assert_(self.cache.get('b') is Miss)
+
+    def testBoundPredicateOnlyIsDropped(self):
+        q = "SELECT ?s WHERE { ?s ?p ?o }"
+        self.cache.set('p', [], q, {'p' : RDFS.label})
+        self.cache.set('po', [], q, {'p' : RDFS.label, 'o' : Literal('old')})
+        self.cache.invalidate([(EXP['x'], RDFS.label, Literal('old'))],
+                              EXP['ctx'])
+        self.assert_(self.cache.get('p') is Miss)
+        self.assert_(self.cache.get('po') is Miss)
+        self.assertEqual(self.cache.get('a'), [])
+
+    def testUnboundSubjectClearsAll(self):
+        self.cache.invalidate([(None, None, None)], EXP['ctx'])
+        self.assertEqual(len(self.cache), 0)
+
+    def testEvictionCleansIndex(self):
+        cache = SubjectCache(maxSize=1)
+        cache.set('a', [], '', {'s' : EXP['a']})
+        cache.set('b', [], '', {'s' : EXP['b']})
+        self.assertEqual(cache._bySubject.keys(), [EXP['b']])
+
+class TermInternerTestCase(unittest.TestCase):
+    def testSharedTerms(self):
+        terms = TermInterner()
+        self.assert_(terms.uri(EXP['a']) is terms.uri(EXP['a']))
+        xsInt = 'http://www.w3.org/2001/XMLSchema#int'
+        lit = terms.literal('1', xsInt)
+        self.assertEqual(lit, Literal('1', datatype=URIRef(xsInt)))
+        self.assert_(lit.datatype is terms.uri(xsInt))
+        self.assertEqual(terms.stats()['hits'], 2)
+
+    def testLanguagesKeptApart(self):
+        terms = TermInterner()
+        self.assertNotEqual(terms.literal('chat', lang='fr').language,
+                            terms.literal('chat', lang='en').language)
+
+    def testClearsWhenFull(self):
+        terms = TermInterner(maxSize=2)
+        for name in 'abc':
+            terms.uri(EXP[name])
+        self.assertEqual(len(terms), 1)
+        self.assertEqual(terms.stats()['clears'], 1)
@@ -27,6 +27,27 @@ class TestCase(unittest.TestCase):
         rows = self.graph.queryd(QUERY.prefixedNames)
         self.assertEqual(list(rows), QUERY.result)
 
+    def testPreparedQuery(self):
+        q = self.graph.prepare(QUERY.name)
+        self.assert_(self.graph.prepare(QUERY.name) is q)
+        rows = self.graph.queryd(q, initBindings=QUERY.nameBindings)
+        self.assertEqual(list(rows), QUERY.result)
+        self.assertEqual(self.graph.countQuery(
+            q, initBindings=QUERY.nameBindings), 1)
+
+    def testUnicodeQuery(self):
+        rows = self.graph.queryd(u'SELECT ?x WHERE { ?x exp:firstName "caf\xe9" }')
+        self.assertEqual(list(rows), [])
+
+    def testParsedQueryCache(self):
+        for i in range(2):
+            rows = self.graph.queryd(QUERY.name,
+                                     initBindings=QUERY.nameBindings)
+            self.assertEqual(list(rows), QUERY.result)
+        st = self.graph.queryCacheStats()
+        self.assertEqual(st['parsed']['misses'], 1)
+        self.assertEqual(st['parsed']['hits'], 1)
+
     def rdflib_broken_testQuerydEmptyNamespace(self):
         rows = self.graph.queryd(QUERY.emptyPrefixNames)
         self.assertEqual(list(rows), QUERY.result)
@@ -46,6 +67,11 @@ class TestCase(unittest.TestCase):
         self.assertEqual(list(rows), [{'name' : Literal("othercontext")}])
         
 
+    def testAsk(self):
+        self.assertEqual(self.graph.queryd("ASK { ?s ?p ?o . }"), True)
+        self.assertEqual(
+            self.graph.queryd("ASK { exp:dp exp:nonexist ?o . }"), False)
+
     def testCountQuery(self):
         n = self.graph.countQuery(QUERY.name, initBindings=QUERY.nameBindings)
         self.assertEqual(n, 1)
@@ -67,6 +93,15 @@ class TestCase(unittest.TestCase):
         for stmt in shared.newStatements:
             self.assert_(self.graph.contains(stmt))
 
+    def testAddBulk(self):
+        graph = Graph2(shared.localGraph(), initNs={'exp' : EXP},
+                       verifyWrites=True)
+        graph.addBulk(iter(shared.newStatements), EXP['ctxnew#context'])
+        for stmt in shared.newStatements:
+            self.assert_(graph.contains(stmt))
+        self.assertEqual(graph.subgraphLength(EXP['ctxnew#context']),
+                         len(shared.newStatements))
+
     def testSave(self):
         self.graph.add(*shared.newStatements,
                        **dict(context=EXP['ctx#context']))
@@ -228,6 +263,17 @@ class TestCase(unittest.TestCase):
         self.graph.safeParse(n3, publicID=EXP['ctxn3#context'], format='n3')
         self.assert_(self.graph.contains((EXP['dp'], EXP['name'],
                                           Literal("from n3"))))
+
+    def testSafeParseTwice(self):
+        for text in ['<http://example.org/x> <http://example.org/name0> "a" .',
+                     '<http://example.org/x> <http://example.org/name0> "b" .']:
+            self.graph.safeParse(StringInputSource(text),
+                                 publicID=EXP['ctxnew#context'], format='nt',
+                                 staged=False)
+        self.assertEqual(self.graph.subgraphLength(EXP['ctxnew#context']), 1)
+        self.assert_(self.graph.contains((EXP['x'], EXP['name0'],
+                                          Literal("b"))))
+
     def testRemove(self):
         s0 = (EXP['x'], EXP['name0'], Literal("a"))
         s1 = (EXP['x'], EXP['name1'], Literal("b"))
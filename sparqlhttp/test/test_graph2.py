@@ -0,0 +1,265 @@
+import sys
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server
+from rdflib import Literal, RDFS
+from rdflib.exceptions import UniquenessError
+sys.path.append("..")
+from sparqlhttp.graph2 import AsyncGraph
+from sparqlhttp.httpclient import PooledHttpClient
+from sparqlhttp.serve import SPARQLResource
+from sparqlhttp.dictquery import Graph2
+from sparqlhttp.cache import LRUCache
+
+import shared
+from shared import EXP, QUERY
+
+class StatementsResource(SPARQLResource):
+    """also takes the sesame POST /statements that AsyncGraph writes
+    with, but only records the bodies"""
+    def render_POST(self, request):
+        if request.path.endswith('/statements'):
+            self.posted.append(request.content.read())
+            return ''
+        return SPARQLResource.render_POST(self, request)
+
+class ServerTestCase(unittest.TestCase):
+    """an AsyncGraph talking to a SPARQLResource on this reactor"""
+    batchLookups = False
+    resourceClass = SPARQLResource
+    def setUp(self):
+        g = shared.localGraph()
+        g.add((EXP['a'], RDFS.label, Literal('A')))
+        g.add((EXP['b'], RDFS.label, Literal('B')))
+        g.add((EXP['twice'], RDFS.label, Literal('one')))
+        g.add((EXP['twice'], RDFS.label, Literal('two')))
+        self.resource = self.resourceClass(Graph2(g, initNs={'exp' : EXP}))
+        self.listen = reactor.listenTCP(0, server.Site(self.resource),
+                                        interface='127.0.0.1')
+        self.graph = AsyncGraph(
+            'sesame', 'http://127.0.0.1:%d/' % self.listen.getHost().port,
+            initNs={'exp' : EXP}, httpClient=PooledHttpClient(),
+            batchLookups=self.batchLookups)
+
+    def tearDown(self):
+        d = self.graph.httpClient.close()
+        d.addCallback(lambda _: self.listen.stopListening())
+        return d
+
+class ValuesTestCase(ServerTestCase):
+    def testOneQuery(self):
+        d = self.graph.values([EXP['a'], EXP['b'], EXP['a']], RDFS.label)
+        @d.addCallback
+        def check(values):
+            self.assertEqual(values, [Literal('A'), Literal('B'), Literal('A')])
+            self.assertEqual(self.resource.stats.queries, 1)
+        return d
+
+    def testDefault(self):
+        d = self.graph.labels([EXP['a'], EXP['nonexist']], default='none')
+        @d.addCallback
+        def check(labels):
+            self.assertEqual(labels, [Literal('A'), 'none'])
+        return d
+
+    def testUniqueness(self):
+        d = self.graph.values([EXP['twice']], RDFS.label)
+        return self.assertFailure(d, UniquenessError)
+
+    def testBatchedQueries(self):
+        self.graph.batchSize = 2
+        d = self.graph.values([EXP['a'], EXP['b'], EXP['twice']], RDFS.label,
+                              any=True)
+        @d.addCallback
+        def check(values):
+            self.assertEqual(values[:2], [Literal('A'), Literal('B')])
+            self.assertEqual(self.resource.stats.queries, 2)
+        return d
+
+class BatchLookupsTestCase(ServerTestCase):
+    batchLookups = True
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.flushes = 0
+        flush = self.graph._flushLookups
+        def countFlushes():
+            self.flushes += 1
+            flush()
+        self.graph._flushLookups = countFlushes
+
+    def testOneQueryPerTurn(self):
+        d = defer.gatherResults([self.graph.value(EXP['a'], RDFS.label),
+                                 self.graph.label(EXP['b']),
+                                 self.graph.value(EXP['nonexist'], RDFS.label,
+                                                  default='none')])
+        @d.addCallback
+        def check(values):
+            self.assertEqual(values, [Literal('A'), Literal('B'), 'none'])
+            self.assertEqual(self.flushes, 1)
+            self.assertEqual(self.resource.stats.queries, 1)
+            return self.graph.value(EXP['b'], RDFS.label)
+        @d.addCallback
+        def nextTurn(value):
+            self.assertEqual(value, Literal('B'))
+            self.assertEqual(self.flushes, 2)
+        return d
+
+    def testUniquenessOnlyFailsItsOwn(self):
+        twice = self.graph.value(EXP['twice'], RDFS.label)
+        a = self.graph.value(EXP['a'], RDFS.label)
+        self.assertFailure(twice, UniquenessError)
+        @a.addCallback
+        def check(value):
+            self.assertEqual(value, Literal('A'))
+        return defer.gatherResults([twice, a])
+
+class EtagTestCase(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.responses = [] # (status, etag)
+        request = self.graph.httpClient.request
+        def recordingRequest(*args, **kw):
+            d = request(*args, **kw)
+            @d.addCallback
+            def record(response):
+                self.responses.append((response[0], response[1].get('etag')))
+                return response
+            return d
+        self.graph.httpClient.request = recordingRequest
+
+    def testNotModified(self):
+        d = self.graph.queryd(QUERY.prefixedNames)
+        @d.addCallback
+        def again(rows):
+            self.assertEqual(rows, QUERY.result)
+            status, etag = self.responses[0]
+            self.assertEqual(status, 200)
+            self.assert_(etag)
+            return self.graph.queryd(QUERY.prefixedNames)
+        @d.addCallback
+        def check(rows):
+            self.assertEqual(rows, QUERY.result)
+            self.assertEqual(self.responses[1], (304, self.responses[0][1]))
+        return d
+
+    def testWriteChangesEtag(self):
+        d = self.graph.queryd(QUERY.prefixedNames)
+        @d.addCallback
+        def write(rows):
+            self.resource.graph.add(
+                (EXP['dp'], EXP['firstName'], Literal('Drew2')),
+                context=EXP['ctx#context'])
+            return self.graph.queryd(QUERY.prefixedNames)
+        @d.addCallback
+        def check(rows):
+            self.assertEqual(len(rows), 2)
+            (status0, etag0), (status1, etag1) = self.responses
+            self.assertEqual(status1, 200)
+            self.assertNotEqual(etag1, etag0)
+        return d
+
+class CountQueryTestCase(ServerTestCase):
+    def testCountAggregateDecidedOnce(self):
+        """this server may or may not do COUNT(*), but after the first
+        count we know, and each count is one request"""
+        d = self.graph.countQuery(QUERY.name, initBindings=QUERY.nameBindings)
+        @d.addCallback
+        def again(n):
+            self.assertEqual(n, 1)
+            self.assert_(self.graph.countAggregate in (True, False))
+            self.queries = self.resource.stats.queries
+            return self.graph.countQuery(
+                "SELECT ?s WHERE { ?s <%s> ?o }" % RDFS.label)
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 5)
+            self.assertEqual(self.resource.stats.queries, self.queries + 1)
+        return d
+
+    def testOwnPrologue(self):
+        """a query with its own PREFIX line counts right, and gives
+        the same countAggregate decision as one without"""
+        d = self.graph.countQuery(
+            "PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>\n"
+            "SELECT ?s WHERE { ?s rdfs:label ?o }")
+        @d.addCallback
+        def plain(n):
+            self.assertEqual(n, 5)
+            self.decided = self.graph.countAggregate
+            self.graph.countAggregate = None
+            return self.graph.countQuery(
+                "SELECT ?s WHERE { ?s <%s> ?o }" % RDFS.label)
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 5)
+            self.assertEqual(self.graph.countAggregate, self.decided)
+        return d
+
+class GraphCacheTestCase(ServerTestCase):
+    resourceClass = StatementsResource
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.resource.posted = []
+        self.graph.cache = LRUCache()
+
+    def testRepeatedQuery(self):
+        d = self.graph.queryd(QUERY.prefixedNames)
+        d.addCallback(lambda rows: self.graph.queryd(QUERY.prefixedNames))
+        @d.addCallback
+        def check(rows):
+            self.assertEqual(rows, QUERY.result)
+            self.assertEqual(self.resource.stats.queries, 1)
+            self.assertEqual(self.graph.cache.hits, 1)
+        return d
+
+    def testWritesInvalidate(self):
+        stmt = (EXP['a'], RDFS.label, Literal('A2'))
+        writes = [lambda: self.graph.add([stmt], EXP['ctx']),
+                  lambda: self.graph.remove([stmt], EXP['ctx']),
+                  lambda: self.graph.subgraphClear(EXP['ctx'])]
+        d = self.graph.queryd(QUERY.prefixedNames)
+        for write in writes:
+            d.addCallback(lambda _, write=write: write())
+            d.addCallback(lambda _: self.graph.queryd(QUERY.prefixedNames))
+        @d.addCallback
+        def check(rows):
+            self.assertEqual(rows, QUERY.result)
+            self.assertEqual(len(self.resource.posted), 3)
+            self.assertEqual(self.resource.stats.queries, 4)
+        return d
+
+    def testSeesItsOwnWrite(self):
+        query = "SELECT ?o WHERE { ?s ?p ?o }"
+        bindings = {'s' : EXP['a'], 'p' : RDFS.label}
+        stmt = (EXP['a'], RDFS.label, Literal('A2'))
+        d = self.graph.queryd(query, bindings)
+        @d.addCallback
+        def write(rows):
+            self.assertEqual(rows, [{'o' : Literal('A')}])
+            # (StatementsResource doesn't write, so the server's
+            # graph gets it here)
+            self.resource.graph.add(stmt, context=EXP['ctx'])
+            return self.graph.add([stmt], EXP['ctx'])
+        d.addCallback(lambda _: self.graph.queryd(query, bindings))
+        @d.addCallback
+        def check(rows):
+            self.assertEqual(sorted(row['o'] for row in rows),
+                             [Literal('A'), Literal('A2')])
+        return d
+
+    def testErrorFromCacheIsAFailure(self):
+        """a cached result that _postProcess rejects fails the
+        deferred, the same as one from the server"""
+        first = self.graph.value(EXP['twice'], RDFS.label)
+        self.assertFailure(first, UniquenessError)
+        @first.addCallback
+        def again(_):
+            second = self.graph.value(EXP['twice'], RDFS.label)
+            self.assert_(isinstance(second, defer.Deferred))
+            return self.assertFailure(second, UniquenessError)
+        @first.addCallback
+        def check(_):
+            self.assertEqual(self.resource.stats.queries, 1)
+        return first
@@ -0,0 +1,61 @@
+import sys
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.web import server, resource, error
+from twisted.web.static import Data
+sys.path.append("..")
+from sparqlhttp.httpclient import PooledHttpClient
+
+class PooledHttpClientTestCase(unittest.TestCase):
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild('doc', Data('hello ' * 1000, 'text/plain'))
+        self.listen = reactor.listenTCP(0, server.Site(root),
+                                        interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.listen.getHost().port
+        self.client = PooledHttpClient()
+
+    def tearDown(self):
+        d = self.client.close()
+        d.addCallback(lambda _: self.listen.stopListening())
+        return d
+
+    def testRequest(self):
+        d = self.client.request('GET', self.url + 'doc')
+        @d.addCallback
+        def check((status, headers, body)):
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['content-type'], 'text/plain')
+            self.assertEqual(body, 'hello ' * 1000)
+        return d
+
+    def testConnectionReused(self):
+        d = self.client.request('GET', self.url + 'doc')
+        d.addCallback(lambda _: self.client.request('GET', self.url + 'doc'))
+        @d.addCallback
+        def check(_):
+            self.assertEqual(self.client.stats(),
+                             dict(requests=2, connectionsOpened=1,
+                                  connectionsReused=1))
+        return d
+
+    def testOnChunk(self):
+        chunks = []
+        d = self.client.request('GET', self.url + 'doc',
+                                onChunk=chunks.append)
+        @d.addCallback
+        def check((status, headers, body)):
+            self.assertEqual(body, '')
+            self.assertEqual(''.join(chunks), 'hello ' * 1000)
+        return d
+
+    def testErrorStatus(self):
+        chunks = []
+        d = self.client.request('GET', self.url + 'nonexist',
+                                onChunk=chunks.append)
+        self.assertFailure(d, error.Error)
+        @d.addCallback
+        def check(err):
+            self.assertEqual(err.status, '404')
+            self.assertEqual(chunks, [])
+        return d
@@ -0,0 +1,75 @@
+import sys
+from StringIO import StringIO
+from twisted.trial import unittest
+from rdflib import URIRef, Literal, BNode
+sys.path.append("..")
+from sparqlhttp.ntriples import (readNTriples, ParseError, lineChunks,
+                                  ChunkTracker, encodeNTriples, ntTerm)
+
+XS_INT = URIRef("http://www.w3.org/2001/XMLSchema#int")
+NT = ''.join('<http://example.org/s%d> <http://example.org/p> "%d" .\n' % (i, i)
+             for i in range(25))
+
+class ReadNTriplesTestCase(unittest.TestCase):
+    def testBatches(self):
+        batches = []
+        n = readNTriples(StringIO(NT), batches.append, batchSize=10)
+        self.assertEqual(n, 25)
+        self.assertEqual(map(len, batches), [10, 10, 5])
+        self.assertEqual(batches[2][4], (URIRef("http://example.org/s24"),
+                                         URIRef("http://example.org/p"),
+                                         Literal("24")))
+
+    def testErrorAfterSomeBatches(self):
+        batches = []
+        self.assertRaises(ParseError, readNTriples,
+                          StringIO(NT + '<http://examplcorrupted'),
+                          batches.append, batchSize=10)
+        self.assertEqual(map(len, batches), [10, 10])
+
+class LineChunksTestCase(unittest.TestCase):
+    def testChunksEndAtLines(self):
+        chunks = list(lineChunks(StringIO(NT), chunkBytes=100))
+        self.assertEqual(''.join(text for start, text in chunks), NT)
+        for start, text in chunks:
+            self.assert_(text.endswith('\n'))
+            self.assertEqual(NT[start:start + len(text)], text)
+
+    def testResume(self):
+        chunks = list(lineChunks(StringIO(NT), chunkBytes=100))
+        offset = chunks[3][0]
+        self.assertEqual(list(lineChunks(StringIO(NT), 100, offset)),
+                         chunks[3:])
+
+    def testTracker(self):
+        chunks = list(lineChunks(StringIO(NT), chunkBytes=100))
+        tracker = ChunkTracker()
+        for start, text in chunks[:3]:
+            tracker.started(start, len(text))
+        tracker.finished(chunks[1][0])
+        self.assertEqual(tracker.safeOffset, 0)
+        tracker.finished(chunks[0][0])
+        self.assertEqual(tracker.safeOffset, chunks[2][0])
+        tracker.finished(chunks[2][0])
+        self.assertEqual(tracker.safeOffset, chunks[3][0])
+
+class EncodeNTriplesTestCase(unittest.TestCase):
+    def testEscapes(self):
+        self.assertEqual(ntTerm(Literal(u'caf\xe9 "q"\n', lang='fr')),
+                         r'"caf\u00E9 \"q\"\n"@fr')
+        self.assertEqual(ntTerm(Literal('3', datatype=XS_INT)),
+                         '"3"^^<http://www.w3.org/2001/XMLSchema#int>')
+        self.assertEqual(ntTerm(BNode('b1')), '_:b1')
+        self.assertRaises(TypeError, ntTerm, 3)
+
+    def testRoundTrip(self):
+        stmts = [(URIRef("http://example.org/s"), URIRef("http://example.org/p"),
+                  o) for o in [Literal(u'tab\t back\\slash \u2603'),
+                               Literal('x', lang='en'),
+                               Literal('3', datatype=XS_INT),
+                               URIRef("http://example.org/o")]]
+        text = encodeNTriples(stmts)
+        self.assert_(isinstance(text, str))
+        batches = []
+        readNTriples(StringIO(text), batches.append)
+        self.assertEqual(batches, [stmts])
@@ -5,9 +5,11 @@ more tests needed:
   more error cases
 """
 
-import os, sys, logging
+import os, sys, logging, urllib
 from twisted.trial import unittest
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.error import ConnectionRefusedError
+from twisted.web import error
 import twisted.web
 from rdflib import Namespace, Literal, RDFS, BNode, Variable, URIRef
 from rdflib.Graph import Graph
@@ -19,6 +21,7 @@ sys.path.append("..")
 from sparqlhttp.remotegraph import RemoteGraph
 from sparqlhttp.serve import SPARQLResource
 from sparqlhttp.dictquery import Graph2
+from sparqlhttp.sparqljson import jsonResults, jsonCountResults
 
 import shared
 from shared import EXP, QUERY
@@ -121,6 +124,17 @@ class Cases(object):
                                            'last' : None}])
         return d
         
+    def testAsk(self):
+        d = self.graph.remoteQueryd("ASK { exp:dp exp:firstName ?o . }")
+        @d.addCallback
+        def check(answer):
+            self.assertEqual(answer, True)
+            return self.graph.remoteQueryd("ASK { exp:dp exp:nonexist ?o . }")
+        @d.addCallback
+        def check2(answer):
+            self.assertEqual(answer, False)
+        return d
+
     def testCountQuery(self):
         d = self.graph.remoteCountQuery(QUERY.name,
                                         initBindings=QUERY.nameBindings)
@@ -322,4 +336,170 @@ class RemoteTestCase(unittest.TestCase, Cases):
                                  resultFormat='xml')
 
     def tearDown(self):
-        self.listen.stopListening()
+        # (the pooled connections would otherwise leave the reactor dirty)
+        d = self.graph.httpClient.close()
+        d.addCallback(lambda _: self.listen.stopListening())
+        return d
+
+    def testQueryStream(self):
+        batches = []
+        d = self.graph.queryStream(QUERY.name, initBindings=QUERY.nameBindings,
+                                   onRows=batches.append)
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 1)
+            self.assertEqual(sum(batches, []), QUERY.result)
+        return d
+
+class RemoteJsonTestCase(RemoteTestCase):
+    def setUp(self):
+        RemoteTestCase.setUp(self)
+        self.graph = RemoteGraph(serverUrl="http://localhost:9991/",
+                                 resultFormat='json')
+
+
+class CannedClient(object):
+    """stands in for a PooledHttpClient. Each request gets the body
+    that answer(query text) returns, or an http 500 if that raises
+    (but a ConnectionRefusedError fails the request as it is, like a
+    server that's down)"""
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+
+    def request(self, method, url, headers=None, body=None, onChunk=None):
+        query = urllib.unquote(url.split('?query=', 1)[1])
+        self.queries.append(query)
+        try:
+            return defer.succeed((200, {}, self.answer(query)))
+        except ConnectionRefusedError:
+            return defer.fail()
+        except Exception, e:
+            return defer.fail(error.Error('500', str(e)))
+
+class CountAggregateTestCase(unittest.TestCase):
+    def graph(self, answer, countAggregate=None):
+        return RemoteGraph(serverUrl="http://localhost:9991/",
+                           resultFormat='json',
+                           countAggregate=countAggregate,
+                           httpClient=CannedClient(answer))
+
+    def testAggregate(self):
+        def answer(query):
+            assert 'COUNT(*)' in query, query
+            return jsonResults([{'sparqlhttpCount' : Literal('42')}],
+                               ['sparqlhttpCount'])
+        graph = self.graph(answer)
+        d = graph.remoteCountQuery(QUERY.name, initBindings=QUERY.nameBindings)
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 42)
+            self.assertEqual(graph.countAggregate, True)
+            self.assertEqual(len(graph.httpClient.queries), 1)
+            self.assert_('SELECT ?name WHERE' in graph.httpClient.queries[0])
+        return d
+
+    def testFallBackOnce(self):
+        def answer(query):
+            if 'COUNT(*)' in query:
+                raise ValueError("no aggregates here")
+            return jsonCountResults(3)
+        graph = self.graph(answer)
+        d = graph.remoteCountQuery(QUERY.name, initBindings=QUERY.nameBindings)
+        @d.addCallback
+        def again(n):
+            self.assertEqual(n, 3)
+            self.assertEqual(graph.countAggregate, False)
+            self.assertEqual(len(graph.httpClient.queries), 2)
+            return graph.remoteCountQuery(QUERY.interpolated)
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 3)
+            queries = graph.httpClient.queries
+            self.assertEqual(len(queries), 3)
+            self.assert_('COUNT(*)' not in queries[2])
+        return d
+
+    def testErrorAfterSuccess(self):
+        def answer(query):
+            raise ValueError("server broke")
+        graph = self.graph(answer, countAggregate=True)
+        d = graph.remoteCountQuery(QUERY.interpolated)
+        return self.assertFailure(d, error.Error)
+
+    def testPrologueOutsideTheSubquery(self):
+        def answer(query):
+            return jsonResults([{'sparqlhttpCount' : Literal('2')}],
+                               ['sparqlhttpCount'])
+        graph = self.graph(answer)
+        d = graph.remoteCountQuery(
+            "PREFIX ex: <http://example.org/>\n"
+            "SELECT ?s FROM <http://example.org/g> WHERE { ?s ex:p ?o }")
+        @d.addCallback
+        def check(n):
+            self.assertEqual(n, 2)
+            query = graph.httpClient.queries[0]
+            self.assert_(query.startswith("PREFIX ex: <http://example.org/>\n"
+                                          "SELECT ( COUNT(*)"), query)
+            self.assert_("FROM <http://example.org/g> WHERE { SELECT ?s WHERE"
+                         in query, query)
+        return d
+
+    def testServerDownLeavesItUndecided(self):
+        def answer(query):
+            raise ConnectionRefusedError()
+        graph = self.graph(answer)
+        d = graph.remoteCountQuery(QUERY.interpolated)
+        self.assertFailure(d, ConnectionRefusedError)
+        @d.addCallback
+        def check(err):
+            self.assertEqual(graph.countAggregate, None)
+            self.assertEqual(len(graph.httpClient.queries), 1)
+        return d
+
+    def testBadQueryLeavesItUndecided(self):
+        """if the plain query fails too, it wasn't the aggregate
+        that the server rejected"""
+        def answer(query):
+            raise ValueError("syntax error")
+        graph = self.graph(answer)
+        d = graph.remoteCountQuery(QUERY.interpolated)
+        self.assertFailure(d, error.Error)
+        @d.addCallback
+        def check(err):
+            self.assertEqual(graph.countAggregate, None)
+            self.assertEqual(len(graph.httpClient.queries), 2)
+        return d
+
+class HeldClient(object):
+    """stands in for a PooledHttpClient. GETs wait until the test
+    fires them, and POSTs succeed right away"""
+    def __init__(self):
+        self.gets = [] # deferreds
+        self.posts = 0
+
+    def request(self, method, url, headers=None, body=None, onChunk=None):
+        if method == 'POST':
+            self.posts += 1
+            return defer.succeed((204, {}, ''))
+        d = defer.Deferred()
+        self.gets.append(d)
+        return d
+
+class WriteGenerationTestCase(unittest.TestCase):
+    def testQueryAfterWriteIsNotCoalesced(self):
+        client = HeldClient()
+        graph = RemoteGraph(serverUrl="http://localhost:9991/",
+                            httpClient=client)
+        before = graph.remoteQueryd(QUERY.interpolated)
+        alsoBefore = graph.remoteQueryd(QUERY.interpolated)
+        self.assertEqual(len(client.gets), 1)
+        write = graph.remoteAdd(shared.newStatement, context=EXP['ctx'])
+        self.assertEqual(client.posts, 1)
+        after = graph.remoteQueryd(QUERY.interpolated)
+        self.assertEqual(len(client.gets), 2)
+
+        body = jsonResults(QUERY.result, ['name'])
+        for d in client.gets:
+            d.callback((200, {}, body))
+        return defer.gatherResults([before, alsoBefore, write, after])
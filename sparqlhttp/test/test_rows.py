@@ -0,0 +1,41 @@
+import sys, operator
+from twisted.trial import unittest
+from rdflib import URIRef, Literal
+sys.path.append("..")
+from sparqlhttp.rows import RowMaker
+from sparqlhttp.sparqljson import jsonResults, parseJsonResults
+
+X = URIRef("http://example.org/x")
+
+class RowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.maker = RowMaker(['s', 'o'])
+        self.row = self.maker.row({'s' : X})
+
+    def testDictAccess(self):
+        self.assertEqual(self.row['s'], X)
+        self.assertEqual(self.row['o'], None)
+        self.assertRaises(KeyError, lambda: self.row['nonexist'])
+        self.assertEqual(self.row.get('nonexist', 1), 1)
+        self.assertEqual(self.row.keys(), ['s', 'o'])
+        self.assertEqual(dict(self.row), {'s' : X, 'o' : None})
+
+    def testEqualsDict(self):
+        self.assertEqual(self.row, {'s' : X, 'o' : None})
+        self.assertNotEqual(self.row, {'s' : X})
+
+    def testImmutable(self):
+        self.assert_(self.row.copy() is self.row)
+        self.assertRaises(TypeError, operator.setitem, self.row, 's', X)
+
+    def testUnexpectedName(self):
+        row = self.maker.row({'s' : X, 'extra' : X})
+        self.assertEqual(row['extra'], X)
+        self.assertEqual(self.row.get('extra'), None)
+
+    def testParsedRowsShareTerms(self):
+        doc = jsonResults([{'s' : X, 'o' : Literal(str(i))}
+                           for i in range(3)], ['s', 'o'])
+        rows = parseJsonResults(doc, compact=True)
+        self.assertEqual(rows[2], {'s' : X, 'o' : Literal('2')})
+        self.assert_(rows[0]['s'] is rows[1]['s'])
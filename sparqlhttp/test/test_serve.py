@@ -0,0 +1,254 @@
+import sys, urllib, threading
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server
+from rdflib import Literal, RDFS
+sys.path.append("..")
+from sparqlhttp.serve import SPARQLResource, ReadWriteLock
+from sparqlhttp.dictquery import Graph2
+from sparqlhttp.httpclient import PooledHttpClient
+from sparqlhttp.sparqljson import parseJsonResults, JsonResultsParser
+from sparqlhttp.sparqlxml import parseSparqlResults, XmlResultsParser
+
+import shared
+from shared import EXP
+
+LABELS = "SELECT ?s ?o WHERE { ?s <%s> ?o }" % RDFS.label
+
+class ReadWriteLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lock = ReadWriteLock()
+        self.events = []
+        self.pending = {}
+
+    def job(self, name):
+        """a job that logs its start and waits for self.finish(name)"""
+        self.events.append('start ' + name)
+        d = self.pending[name] = defer.Deferred()
+        return d
+
+    def finish(self, name):
+        self.pending.pop(name).callback(name)
+
+    def testReadersShare(self):
+        self.lock.runRead(self.job, 'r1')
+        self.lock.runRead(self.job, 'r2')
+        self.assertEqual(self.events, ['start r1', 'start r2'])
+
+    def testWriterWaitsForReaders(self):
+        self.lock.runRead(self.job, 'r1')
+        self.lock.runWrite(self.job, 'w')
+        self.assertEqual(self.events, ['start r1'])
+        self.finish('r1')
+        self.assertEqual(self.events, ['start r1', 'start w'])
+
+    def testWaitingWriterHoldsOffNewReaders(self):
+        self.lock.runRead(self.job, 'r1')
+        self.lock.runWrite(self.job, 'w')
+        self.lock.runRead(self.job, 'r2')
+        self.finish('r1')
+        self.assertEqual(self.events, ['start r1', 'start w'])
+        self.finish('w')
+        self.assertEqual(self.events, ['start r1', 'start w', 'start r2'])
+
+    def testErrorReleases(self):
+        d = self.lock.runWrite(lambda: 1 / 0)
+        self.assertFailure(d, ZeroDivisionError)
+        self.lock.runRead(self.job, 'r')
+        self.assertEqual(self.events, ['start r'])
+        return d
+
+class LiveServerTestCase(unittest.TestCase):
+    """a SPARQLResource on this reactor, and a client for it. The
+    graph has 11 labels"""
+    resourceArgs = {}
+    def setUp(self):
+        self.resource = SPARQLResource(self.makeGraph(), **self.resourceArgs)
+        self.listen = reactor.listenTCP(0, server.Site(self.resource),
+                                        interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.listen.getHost().port
+        self.client = PooledHttpClient()
+
+    def makeGraph(self):
+        g = shared.localGraph()
+        for i in range(10):
+            g.add((EXP['item%s' % i], RDFS.label, Literal('item %s' % i)))
+        return Graph2(g, initNs={'exp' : EXP})
+
+    def tearDown(self):
+        if self.resource.threadPool is not None:
+            self.resource.threadPool.stop()
+        d = self.client.close()
+        d.addCallback(lambda _: self.listen.stopListening())
+        return d
+
+    def query(self, query, accept='application/sparql-results+json',
+              **kw):
+        """deferred to the client's (status, headers, body)"""
+        return self.client.request(
+            'GET', self.url + '?query=' + urllib.quote(query, safe=''),
+            headers={'Accept' : accept}, **kw)
+
+class StreamingTestCase(LiveServerTestCase):
+    """records the deferred of each streamed response"""
+    def setUp(self):
+        LiveServerTestCase.setUp(self)
+        self.streams = [] # the deferreds from _streamResponse
+        streamResponse = self.resource._streamResponse
+        def recordingStreamResponse(*args):
+            d = streamResponse(*args)
+            self.streams.append(d)
+            return d
+        self.resource._streamResponse = recordingStreamResponse
+
+class StreamTestCase(StreamingTestCase):
+    resourceArgs = dict(streamChunkRows=2)
+
+    def labels(self, rows):
+        return sorted((row['s'], row['o']) for row in rows)
+
+    def roundTrip(self, accept, parse, parserClass):
+        pieces = []
+        d = self.query(LABELS, accept=accept, onChunk=pieces.append)
+        @d.addCallback
+        def check(response):
+            self.assertEqual(len(self.streams), 1)
+            expected = self.labels(self.resource.graph.queryd(LABELS))
+            self.assertEqual(len(expected), 11)
+            body = ''.join(pieces)
+            self.assertEqual(self.labels(parse(body)), expected)
+
+            parser = parserClass()
+            rows = []
+            for start in range(0, len(body), 7):
+                rows.extend(parser.feed(body[start:start + 7]))
+            parser.close()
+            self.assertEqual(self.labels(rows), expected)
+        return d
+
+    def testJson(self):
+        return self.roundTrip('application/sparql-results+json',
+                              parseJsonResults, JsonResultsParser)
+
+    def testXml(self):
+        return self.roundTrip('application/sparql-results+xml',
+                              parseSparqlResults, XmlResultsParser)
+
+class StreamDisconnectTestCase(StreamingTestCase):
+    resourceArgs = dict(streamChunkRows=1)
+    totalRows = 100000
+
+    def makeGraph(self):
+        graph = StreamingTestCase.makeGraph(self)
+        self.pulled = 0
+        def manyRows(query):
+            for i in xrange(self.totalRows):
+                self.pulled += 1
+                yield {'s' : EXP['item%s' % i], 'o' : Literal('item')}
+        graph.queryd = manyRows
+        return graph
+
+    def testDisconnectStopsTask(self):
+        class HungUp(Exception):
+            pass
+        def hangUp(data):
+            raise HungUp()
+        d = self.query(LABELS, onChunk=hangUp)
+        self.assertFailure(d, HungUp)
+        # the stream's deferred fires once the task is stopped
+        d.addCallback(lambda _: self.streams[0])
+        @d.addCallback
+        def check(result):
+            self.assertEqual(result, server.NOT_DONE_YET)
+            self.assert_(0 < self.pulled < self.totalRows, self.pulled)
+            self.assertEqual(self.resource.stats.lastError, '')
+        return d
+
+class ThreadedStreamTestCase(LiveServerTestCase):
+    resourceArgs = dict(streamChunkRows=2, queryThreads=2)
+
+    def makeGraph(self):
+        graph = LiveServerTestCase.makeGraph(self)
+        self.pulls = [] # (thread, lock readers) as each row is made
+        queryd = graph.queryd
+        def recordingQueryd(*args, **kw):
+            rows = queryd(*args, **kw)
+            if isinstance(rows, bool):
+                return rows
+            return self.recordPulls(rows)
+        graph.queryd = recordingQueryd
+        return graph
+
+    def recordPulls(self, rows):
+        for row in rows:
+            self.pulls.append((threading.currentThread(),
+                               self.resource.lock.readers))
+            yield row
+
+    def testRowsPulledInPoolUnderReadLock(self):
+        d = self.query(LABELS)
+        @d.addCallback
+        def check(response):
+            self.assertEqual(len(parseJsonResults(response[2])), 11)
+            self.assertEqual(len(self.pulls), 11)
+            for thread, readers in self.pulls:
+                self.assertNotEqual(thread, threading.currentThread())
+                self.assertEqual(readers, 1)
+            self.assertEqual(self.resource.lock.readers, 0)
+        return d
+
+class ResponseCacheTestCase(LiveServerTestCase):
+    def setUp(self):
+        LiveServerTestCase.setUp(self)
+        self.evaluated = 0
+        queryd = self.resource.graph.queryd
+        def countingQueryd(*args, **kw):
+            self.evaluated += 1
+            return queryd(*args, **kw)
+        self.resource.graph.queryd = countingQueryd
+
+    def testRepeatedQuery(self):
+        d = self.query(LABELS)
+        d.addCallback(lambda first: self.query(LABELS).addCallback(
+            lambda second: (first, second)))
+        @d.addCallback
+        def check((first, second)):
+            self.assertEqual(second[2], first[2])
+            self.assertEqual(second[1]['etag'], first[1]['etag'])
+            self.assertEqual(self.evaluated, 1)
+            self.assertEqual(self.resource.responseCache.hits, 1)
+        return d
+
+    def testWriteInvalidates(self):
+        d = self.query(LABELS)
+        @d.addCallback
+        def write(response):
+            self.resource.graph.add((EXP['new'], RDFS.label, Literal('new')),
+                                    context=EXP['ctx'])
+            return self.query(LABELS)
+        @d.addCallback
+        def check(response):
+            self.assertEqual(len(parseJsonResults(response[2])), 12)
+            self.assertEqual(self.evaluated, 2)
+            self.assertEqual(self.resource.responseCache.hits, 0)
+        return d
+
+    def testBigBodyNotKept(self):
+        self.resource.maxCachedBodyBytes = 100
+        d = self.query(LABELS)
+        @d.addCallback
+        def check(response):
+            self.assert_(len(response[2]) > 100)
+            self.assertEqual(len(self.resource.responseCache), 0)
+        return d
+
+    def testStatusPage(self):
+        d = self.query(LABELS)
+        d.addCallback(lambda _: self.query(LABELS))
+        d.addCallback(lambda _: self.client.request('GET', self.url))
+        @d.addCallback
+        def check(response):
+            self.assert_('1<span> hits, </span>1<span> misses' in response[2],
+                         response[2])
+            self.assert_('1<span> of </span>100<span> entries' in response[2])
+        return d
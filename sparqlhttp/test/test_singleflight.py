@@ -0,0 +1,53 @@
+import sys
+from twisted.trial import unittest
+from twisted.internet import defer
+sys.path.append("..")
+from sparqlhttp.remotegraph import SingleFlight
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.pending = []
+
+    def call(self):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def testSameKeySharesOneCall(self):
+        results = []
+        for i in range(3):
+            self.flight.run('q', self.call).addCallback(results.append)
+        self.assertEqual(len(self.pending), 1)
+        self.assertEqual(self.flight.coalesced, 2)
+        self.pending[0].callback([{'x' : 1}])
+        self.assertEqual(results, [[{'x' : 1}]] * 3)
+
+    def testCallersGetTheirOwnRows(self):
+        results = []
+        for i in range(2):
+            self.flight.run('q', self.call).addCallback(results.append)
+        self.pending[0].callback([{'x' : 1}])
+        results[0][0]['x'] = 2
+        self.assertEqual(results[1], [{'x' : 1}])
+
+    def testDifferentKeys(self):
+        self.flight.run('q1', self.call)
+        self.flight.run('q2', self.call)
+        self.assertEqual(len(self.pending), 2)
+
+    def testFinishedKeyRunsAgain(self):
+        self.flight.run('q', self.call)
+        self.pending[0].callback([])
+        self.flight.run('q', self.call)
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(len(self.flight), 1)
+
+    def testErrorGoesToEveryCaller(self):
+        failures = []
+        for i in range(2):
+            self.flight.run('q', self.call).addErrback(failures.append)
+        self.pending[0].errback(ValueError("server down"))
+        self.assertEqual([f.check(ValueError) for f in failures],
+                         [ValueError, ValueError])
+        self.assertEqual(len(self.flight), 0)
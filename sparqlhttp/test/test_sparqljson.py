@@ -0,0 +1,47 @@
+import sys
+from twisted.trial import unittest
+from rdflib import URIRef, Literal
+sys.path.append("..")
+from sparqlhttp import sparqljson
+from sparqlhttp.sparqljson import (jsonResults, parseJsonResults,
+                                   JsonResultsParser, iterJsonResults)
+
+ROWS = [dict(x=URIRef("http://example.org/%d" % i),
+             y=Literal(u'caf\xe9 "%d"' % i, lang='fr'))
+        for i in range(20)]
+DOC = jsonResults(ROWS, ['x', 'y'])
+
+class JsonResultsParserTestCase(unittest.TestCase):
+    def testWholeDocument(self):
+        self.assertEqual(list(iterJsonResults([DOC])), parseJsonResults(DOC))
+
+    def testSmallPieces(self):
+        for size in [1, 5, 64]:
+            pieces = [DOC[i:i + size] for i in range(0, len(DOC), size)]
+            self.assertEqual(list(iterJsonResults(pieces)), ROWS)
+
+    def testRowsArriveEarly(self):
+        parser = JsonResultsParser()
+        rows = parser.feed(DOC[:len(DOC) // 2])
+        self.assert_(0 < len(rows) < len(ROWS))
+
+    def testOtherKeysSkipped(self):
+        doc = DOC.replace('"results": {',
+                          '"results": {"distinct": false, "n": 12, ')
+        self.assertEqual(list(iterJsonResults([doc])), ROWS)
+
+    def testTruncated(self):
+        self.assertRaises(ValueError, list, iterJsonResults([DOC[:-10]]))
+
+class JsonBackendTestCase(unittest.TestCase):
+    def tearDown(self):
+        sparqljson.setJsonBackend(sparqljson.jsonBackends[0][0])
+
+    def testEveryBackendParses(self):
+        for name, loads, takesBytes in sparqljson.jsonBackends:
+            sparqljson.setJsonBackend(name)
+            self.assertEqual(parseJsonResults(DOC), ROWS)
+            self.assertEqual(parseJsonResults(DOC.decode('utf8')), ROWS)
+
+    def testUnknownBackend(self):
+        self.assertRaises(ValueError, sparqljson.setJsonBackend, 'nonexist')